@@ -1,6 +1,12 @@
+import asyncio
 import base64
+import hashlib
+import io
 import mimetypes
-from typing import IO, Sequence
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import IO, AsyncIterator, Iterable, Iterator, NamedTuple, Sequence
 
 from langchain.agents.middleware import (
     AgentState,
@@ -8,18 +14,182 @@ from langchain.agents.middleware import (
 from langchain_core.documents import Document
 from langchain_core.messages import FileContentBlock, HumanMessage, TextContentBlock
 from langchain_google_genai import ChatGoogleGenerativeAI
-from llama_parse import LlamaParse
 
+import database
+import metrics
+from answer_cache import AnswerCache, normalize_query, replay, source_set_key
+from attachments import AttachmentManager, GeminiFileService
+from context_builder import (
+    PDF_PAGE_TOKENS,
+    build_context,
+    estimate_tokens,
+    excerpts,
+    pdf_pages,
+)
 from database import FileItem
 from vector_store import VectorStoreHelper
 
+GEMINI_MIME_TYPES = [
+    # Images
+    "image/png",
+    "image/jpeg",
+    "image/webp",
+    "image/heic",
+    "image/heif",
+    # Audio
+    "audio/aac",
+    "audio/flac",
+    "audio/mp3",
+    "audio/m4a",
+    "audio/mpeg",
+    "audio/mpga",
+    "audio/mp4",
+    "audio/ogg",
+    "audio/pcm",
+    "audio/wav",
+    "audio/webm",
+    # Video
+    "video/x-flv",
+    "video/quicktime",
+    "video/mpeg",
+    "video/mpegs",
+    "video/mpg",
+    "video/mp4",
+    "video/webm",
+    "video/wmv",
+    "video/3gpp",
+    # Documents/Text
+    "application/pdf",
+    "text/plain",
+]
+
+# Bump to discard cached per-source summaries after changing the map prompt
+SUMMARY_VERSION = "1"
+
+SUMMARY_PROMPT = """
+        You will be given one or more files (PDF, TXT, DOCX, Markdown, or other text-based formats). Your task is to produce a clear, accurate, and concise summary of the combined contents. Follow these rules:
+        Read all provided files and treat them as a unified information set.
+        Identify the key ideas, major topics, important data points, and recurring themes.
+        Do not include unnecessary detail—focus on essential information only.
+        Preserve meaning: ensure the summary reflects the original content without introducing new assumptions.
+        If the files contain multiple topics, organize the summary with logical sections or bullet points.
+        If any file is unreadable or empty, state this clearly but continue summarizing the rest.
+        IMPORTANT: If you reference any currency values or dollar amounts, you must escape all dollar signs by prefixing them with a backslash (\\$).
+        Example: write \\$1500 instead of $1500.
+        Apply this everywhere a dollar sign would appear, including inside code blocks.
+        Do not mention file formats unless relevant to content.
+        Output format:
+        A concise overall summary (1–3 paragraphs).
+        Followed by bullet-point highlights of the most important information.
+        All dollar signs escaped.
+        Begin once the files are provided.
+"""
+
+
+SOURCE_SUMMARY_PROMPT = """
+        You will be given one source (a file, a web page, or part of one). Summarize it so the summary can later be combined with summaries of other sources.
+        Identify the key ideas, major topics, important data points, names, figures and dates.
+        Preserve meaning: do not introduce new assumptions.
+        If the source is unreadable or empty, say so in one sentence.
+        IMPORTANT: If you reference any currency values or dollar amounts, you must escape all dollar signs by prefixing them with a backslash (\\$).
+        Respond with the summary only.
+"""
+
+COMBINE_PROMPT = """
+        You will be given summaries of one or more sources, each under a heading with the source's title. Treat them as a unified information set and follow these rules:
+        Identify the key ideas, major topics, important data points, and recurring themes across all sources.
+        Do not include unnecessary detail—focus on essential information only.
+        Preserve meaning: ensure the summary reflects the summaries without introducing new assumptions.
+        If the sources contain multiple topics, organize the summary with logical sections or bullet points.
+        If a source is noted as unreadable or empty, state this clearly but continue summarizing the rest.
+        IMPORTANT: If you reference any currency values or dollar amounts, you must escape all dollar signs by prefixing them with a backslash (\\$).
+        Example: write \\$1500 instead of $1500.
+        Apply this everywhere a dollar sign would appear, including inside code blocks.
+        Output format:
+        A concise overall summary (1–3 paragraphs).
+        Followed by bullet-point highlights of the most important information.
+        All dollar signs escaped.
+
+        Source summaries:
+"""
+
 
 class State(AgentState):
     context: list[Document]
 
 
+class _Prompt(NamedTuple):
+    retrieved_docs: list[tuple[Document, float]]
+    message: HumanMessage | None
+    cache_key: tuple | None
+    # Set instead of `message` when the answer came from the cache
+    cached: str | None
+
+
+def _in_own_session(func, *args):
+    """Run `func` on a worker thread, closing that thread's session after."""
+    try:
+        return func(*args)
+    finally:
+        database.db_session.remove()
+
+
+def _timed_stream(
+    stream: Iterator, timings: dict[str, float], start: float, source: str
+):
+    """Pass `stream` through, recording time to first chunk and in total.
+
+    `source` names the metrics, e.g. "llm" for a live generation.
+    """
+    for chunk in stream:
+        if "first_token" not in timings:
+            timings["first_token"] = time.perf_counter() - start
+            metrics.observe(f"{source}.first_token", timings["first_token"])
+        yield chunk
+    timings["total"] = time.perf_counter() - start
+    metrics.observe(f"{source}.stream", timings["total"])
+
+
+async def _atimed_stream(
+    stream: AsyncIterator, timings: dict[str, float], start: float, source: str
+):
+    async for chunk in stream:
+        if "first_token" not in timings:
+            timings["first_token"] = time.perf_counter() - start
+            metrics.observe(f"{source}.first_token", timings["first_token"])
+        yield chunk
+    timings["total"] = time.perf_counter() - start
+    metrics.observe(f"{source}.stream", timings["total"])
+
+
+async def _aiter(items: Iterable):
+    for item in items:
+        yield item
+
+
 class Agent:
-    def __init__(self, gemini_api_key, llamaidx_api_key):
+    def __init__(
+        self,
+        gemini_api_key,
+        llamaidx_api_key,
+        retrieval_k: int = 2,
+        score_threshold: float | None = None,
+        summary_concurrency: int = 4,
+        summary_group_chars: int = 200_000,
+        answer_cache_threshold: float = 0.95,
+        answer_cache_ttl: float = 24 * 60 * 60,
+        context_token_budget: int | None = 4000,
+        attachment_token_budget: int = 8000,
+    ):
+        self.retrieval_k = retrieval_k
+        # Budgets are in estimated tokens: retrieved context beyond the first
+        # is trimmed (MMR retrieval also picks within it), and text
+        # attachments beyond the second are excerpted
+        self.context_token_budget = context_token_budget
+        self.attachment_token_budget = attachment_token_budget
+        self.score_threshold = score_threshold
+        self.summary_concurrency = summary_concurrency
+        self.summary_group_chars = summary_group_chars
         self.model = ChatGoogleGenerativeAI(
             model="gemini-2.5-pro", api_key=gemini_api_key
         )
@@ -28,7 +198,17 @@ class Agent:
             llamaidx_api_key,
             self.model,
         )
-        self.file_parser = LlamaParse(api_key=llamaidx_api_key)
+        # Share the vector store's parser rather than opening a second client
+        self.file_parser = self.vector_store.parser
+        self.answer_cache = AnswerCache(
+            database.data_path("answer_cache.sqlite"),
+            threshold=answer_cache_threshold,
+            ttl=answer_cache_ttl,
+        )
+        self.attachments = AttachmentManager(GeminiFileService(gemini_api_key))
+
+        # Summaries from an older map prompt will never be hit again
+        database.invalidate_summaries(keep_version=SUMMARY_VERSION)
 
     def create_file_block(
         self, file: IO[bytes] | None = None, file_item: FileItem | None = None
@@ -39,80 +219,259 @@ class Agent:
         elif file_item:
             name = file_item.path
         mime_type, _ = mimetypes.guess_type(name)  # type:ignore
-        gemini_supported_mimetypes = [
-            # Images
-            "image/png",
-            "image/jpeg",
-            "image/webp",
-            "image/heic",
-            "image/heif",
-            # Audio
-            "audio/aac",
-            "audio/flac",
-            "audio/mp3",
-            "audio/m4a",
-            "audio/mpeg",
-            "audio/mpga",
-            "audio/mp4",
-            "audio/ogg",
-            "audio/pcm",
-            "audio/wav",
-            "audio/webm",
-            # Video
-            "video/x-flv",
-            "video/quicktime",
-            "video/mpeg",
-            "video/mpegs",
-            "video/mpg",
-            "video/mp4",
-            "video/webm",
-            "video/wmv",
-            "video/3gpp",
-            # Documents/Text
-            "application/pdf",
-            "text/plain",
-        ]
 
-        if file:
-            file.seek(0)
-            raw_bytes = file.read()
-        elif file_item:
-            raw_bytes = file_item.raw_bytes
+        if file_item and file_item.mime_type in GEMINI_MIME_TYPES:
+            mime_type = file_item.mime_type
 
-        if mime_type not in gemini_supported_mimetypes:
-            docs = self.file_parser.load_data(raw_bytes, extra_info={"file_name": name})
+        if mime_type not in GEMINI_MIME_TYPES:
+            # Parsed text is cached by content hash, so files that were already
+            # indexed or summarized aren't sent through LlamaParse again
+            if file:
+                docs = self.vector_store.parse_upload(file)
+            else:
+                docs = self.vector_store.parse_file(file_item)
 
             return [
                 FileContentBlock(
                     type="file",
-                    base64=base64.b64encode(i.text.encode()).decode(),
+                    base64=base64.b64encode(i.page_content.encode()).decode(),
                     mime_type="text/plain",
                 )
                 for i in docs
             ]
 
-        return [
-            FileContentBlock(
-                type="file",
-                base64=base64.b64encode(raw_bytes).decode(),
-                mime_type=mime_type,
+        if file:
+            file.seek(0, io.SEEK_END)
+            size = file.tell()
+        else:
+            size = file_item.size
+        if self.attachments.should_upload(size):
+            # Reference the provider's copy instead of sending the bytes again
+            with metrics.span("attachments.reference", file=name) as attrs:
+                try:
+                    handle = self._file_handle(mime_type, file, file_item)
+                    return [
+                        FileContentBlock(
+                            type="file", file_id=handle.uri, mime_type=handle.mime_type
+                        )
+                    ]
+                except Exception as e:
+                    # Send it inline below, and say so in the span
+                    attrs["fallback"] = repr(e)
+
+        if file:
+            file.seek(0)
+            raw_bytes = file.read()
+        else:
+            # Map the blob instead of reading it so the only full copy held in
+            # memory is the base64 string
+            raw_bytes = file_item.mmap() if file_item.size else b""
+
+        try:
+            return [
+                FileContentBlock(
+                    type="file",
+                    base64=base64.b64encode(raw_bytes).decode(),
+                    mime_type=mime_type,
+                )
+            ]
+        finally:
+            if not isinstance(raw_bytes, bytes):
+                raw_bytes.close()
+
+    def _file_handle(
+        self, mime_type: str, file: IO[bytes] | None, file_item: FileItem | None
+    ):
+        if file_item:
+            return self.attachments.handle(
+                file_item.blob_hash, mime_type, file_item.open, file_item.path
             )
-        ]
 
-    def new_prompt(self, text: str, files: Sequence[IO[bytes]]):
-        retrieved_docs = self.vector_store.similarity_search(text, k=2)
+        file.seek(0)
+        blob_hash = hashlib.file_digest(file, "sha256").hexdigest()
+
+        def reopen():
+            file.seek(0)
+            return nullcontext(file)
+
+        return self.attachments.handle(blob_hash, mime_type, reopen, file.name)
+
+    def new_prompt(
+        self,
+        text: str,
+        files: Sequence[IO[bytes]],
+        src_ids: Iterable[int] | None = None,
+        timings: dict[str, float] | None = None,
+    ):
+        """Answer `text` from the enabled sources and any attached files.
+
+        Synchronous facade over `anew_prompt` for the Streamlit page: the
+        retrieval and attachment stages run concurrently on an event loop,
+        then the answer streams from the sync model client.
+
+        Returns (retrieved docs with scores, response stream). Questions close
+        enough to one already answered against the same, unchanged sources
+        replay the cached answer instead of generating a new one. Prompts
+        with attachments always go to the model.
+
+        Args:
+            timings: If given, filled with the seconds spent in each stage.
+                "first_token" and "total" are added as the stream is consumed.
+        """
+        start = time.perf_counter()
+        timings = {} if timings is None else timings
+        prompt = asyncio.run(self._prepare_prompt(text, files, src_ids, timings))
+        if prompt.cached is not None:
+            stream, source = replay(prompt.cached), "answer_cache"
+        else:
+            stream, source = self.model.stream([prompt.message]), "llm"
+            if prompt.cache_key:
+                stream = self._cache_answer(
+                    stream, prompt.cache_key, prompt.retrieved_docs
+                )
+        return prompt.retrieved_docs, _timed_stream(stream, timings, start, source)
+
+    async def anew_prompt(
+        self,
+        text: str,
+        files: Sequence[IO[bytes]],
+        src_ids: Iterable[int] | None = None,
+        timings: dict[str, float] | None = None,
+    ):
+        """Async `new_prompt`. The response is an async iterator of chunks."""
+        start = time.perf_counter()
+        timings = {} if timings is None else timings
+        prompt = await self._prepare_prompt(text, files, src_ids, timings)
+        if prompt.cached is not None:
+            stream, source = _aiter(replay(prompt.cached)), "answer_cache"
+        else:
+            stream, source = self.model.astream([prompt.message]), "llm"
+            if prompt.cache_key:
+                stream = self._acache_answer(
+                    stream, prompt.cache_key, prompt.retrieved_docs
+                )
+        return prompt.retrieved_docs, _atimed_stream(stream, timings, start, source)
+
+    async def _prepare_prompt(
+        self,
+        text: str,
+        files: Sequence[IO[bytes]],
+        src_ids: Iterable[int] | None,
+        timings: dict[str, float],
+    ) -> _Prompt:
+        """Embed the query, then look up the answer cache, retrieve and parse
+        attachments at once.
+
+        Each stage runs in a worker thread. The query is embedded once, for
+        both the lookup and retrieval. Attachments are parsed in parallel with
+        each other and with retrieval. Prompts with attachments never use the
+        cache, so they skip the embedding and lookup stages.
+        """
+        start = time.perf_counter()
+        src_ids = None if src_ids is None else list(src_ids)
+
+        async def stage(name: str, func, *args):
+            stage_start = time.perf_counter()
+            try:
+                with metrics.span(f"prompt.{name}"):
+                    return await asyncio.to_thread(_in_own_session, func, *args)
+            finally:
+                timings[name] = time.perf_counter() - stage_start
+
+        async def parse_attachments():
+            stage_start = time.perf_counter()
+            try:
+                with metrics.span("prompt.attachments", files=len(files)):
+                    return await asyncio.gather(
+                        *(
+                            asyncio.to_thread(
+                                _in_own_session, self._attachment_blocks, f, text
+                            )
+                            for f in files
+                        )
+                    )
+            finally:
+                timings["attachments"] = time.perf_counter() - stage_start
+
+        with metrics.span("prompt.prepare", attachments=len(files)) as attrs:
+            query_vector = None
+            if not files:
+                # One embedding serves both the cache lookup and retrieval
+                query_vector = await stage("embed", self._embed_query, text)
+
+            async def lookup():
+                if query_vector is None:
+                    return None, None
+                return await stage("cache", self._cached_answer, src_ids, query_vector)
+
+            # Retrieval doesn't wait for the lookup; with the query already
+            # embedded both are local, and on a hit the retrieval is discarded
+            (retrieved_docs, blocks), (cache_key, hit) = await asyncio.gather(
+                asyncio.gather(
+                    stage("retrieval", self._retrieve, text, src_ids, query_vector),
+                    parse_attachments(),
+                ),
+                lookup(),
+            )
+            if hit:
+                response, retrieved_docs = hit
+                timings["prepare"] = time.perf_counter() - start
+                attrs["cached"] = True
+                return _Prompt(retrieved_docs, None, None, response)
+
+            file_blocks = [block for file_blocks in blocks for block in file_blocks]
+            message = HumanMessage(
+                content_blocks=[  # type: ignore
+                    TextContentBlock(
+                        type="text", text=self._augmented_prompt(text, retrieved_docs)
+                    ),
+                ]
+                + file_blocks
+            )
+            timings["prepare"] = time.perf_counter() - start
+            attrs["cached"] = False
+            return _Prompt(retrieved_docs, message, cache_key, None)
+
+    def _retrieve(
+        self,
+        text: str,
+        src_ids: list[int] | None,
+        query_vector: list[float] | None = None,
+    ):
+        return self.vector_store.similarity_search(
+            text,
+            k=self.retrieval_k,
+            src_ids=src_ids,
+            score_threshold=self.score_threshold,
+            query_vector=query_vector,
+            token_budget=self.context_token_budget,
+        )
+
+    def _augmented_prompt(self, text: str, retrieved_docs) -> str:
         # Build a docs content block that includes a short source header for
-        # each retrieved chunk so the model can cite sources.
+        # each retrieved passage so the model can cite sources. Overlapping
+        # chunks are merged and the whole is kept within the context budget.
+        with metrics.span("prompt.context", chunks=len(retrieved_docs)) as attrs:
+            context = build_context(retrieved_docs, self.context_token_budget)
+            attrs.update(
+                passages=len(context.passages),
+                tokens=context.tokens,
+                dropped=context.dropped,
+                trimmed=context.trimmed,
+            )
+
         docs_content_parts = []
-        for doc, score in retrieved_docs:
-            src = doc.metadata.get("file") or "unknown file"
+        for passage in context.passages:
+            doc = passage.doc
+            src = doc.metadata.get("title") or doc.metadata.get("source")
+            src = src or "unknown file"
             page = doc.metadata.get("page") or "unknown page"
-            header = f"Relevance: {score * 100}%\nSource: `{src} (page {page})`"
+            header = f"Relevance: {passage.score * 100}%\nSource: `{src} (page {page})`"
 
             docs_content_parts.append(f"{header}\n{doc.page_content}")
 
         docs_content = "\n\n".join(docs_content_parts)
-        augmented_message_content = (
+        return (
             "You are a helpful assistant. If you use any of the following context,"
             "be sure to cite the source. Ignore any sources that are not useful."
             "If you cannot find any helpful sources, you may pull from your own knowledge, but warn the user.\n"
@@ -122,58 +481,194 @@ class Agent:
             f"User's query:\n {text}"
         )
 
-        file_blocks: list[FileContentBlock] = []
-        for i in files:
-            i.seek(0)
-            raw = i.read()
-            if not raw:
-                print("Empty file")
-                continue
+    def _attachment_blocks(self, file: IO[bytes], query: str) -> list:
+        file.seek(0, io.SEEK_END)
+        size = file.tell()
+        if not size:
+            print("Empty file")
+            return []
 
-            file_blocks += self.create_file_block(i)
+        mime_type, _ = mimetypes.guess_type(file.name)
+        kind = (mime_type or "").split("/")[0]
+        if kind in ("image", "audio", "video"):
+            # Media can't be excerpted
+            return self.create_file_block(file)
 
-        return retrieved_docs, self.model.stream(
-            [
-                HumanMessage(
-                    content_blocks=[  # type: ignore
-                        TextContentBlock(type="text", text=augmented_message_content),
-                    ]
-                    + file_blocks
-                )
-            ]
+        budget = self.attachment_token_budget
+        if mime_type == "text/plain":
+            file.seek(0)
+            docs = [Document(page_content=file.read().decode(errors="replace"))]
+        else:
+            if mime_type == "application/pdf":
+                # The model reads PDFs natively, so one that fits by its page
+                # count is sent without parsing it
+                file.seek(0)
+                pages = pdf_pages(file.read())
+                if pages is not None and pages * PDF_PAGE_TOKENS <= budget:
+                    return self.create_file_block(file)
+            # Other types are sent as parsed text anyway. The parse is cached
+            # by content hash, so it's reused by the block below and later turns
+            docs = self.vector_store.parse_upload(file)
+        tokens = sum(estimate_tokens(d.page_content) for d in docs)
+        if tokens <= budget:
+            return self.create_file_block(file)
+
+        with metrics.span("prompt.excerpt", file=file.name, tokens=tokens) as attrs:
+            excerpt = excerpts(docs, query, budget)
+            attrs["excerpt_tokens"] = estimate_tokens(excerpt)
+        return [
+            TextContentBlock(
+                type="text",
+                text=f"Excerpts of the attached file `{file.name}` "
+                f"relevant to the query:\n{excerpt}",
+            )
+        ]
+
+    def _embed_query(self, text: str) -> list[float] | None:
+        """Embedding of the normalized query, or None if unavailable.
+
+        The same vector keys the answer cache and drives retrieval, so a
+        prompt costs one embedding call. Normalizing only folds case and
+        whitespace, which lets trivially different questions share answers
+        without changing what retrieval finds.
+        """
+        with metrics.span("embeddings.query") as attrs:
+            try:
+                return self.vector_store.embeddings.embed_query(normalize_query(text))
+            except Exception as e:
+                # Answering still works without the embedding API, just uncached
+                attrs["fallback"] = repr(e)
+                return None
+
+    def _cached_answer(self, src_ids: Iterable[int] | None, query_vector):
+        """(cache key, cached (answer, retrieved docs) or None).
+
+        The key is (model, source set key, query embedding).
+        """
+        versions = database.get_source_versions(src_ids)
+        cache_key = (self.model.model, source_set_key(versions), query_vector)
+        return cache_key, self.answer_cache.get(*cache_key)
+
+    def _cache_answer(self, stream, cache_key: tuple, retrieved_docs) -> Iterator:
+        """Pass `stream` through, caching the full answer once it completes."""
+        parts = []
+        for chunk in stream:
+            parts.append(str(chunk.content))
+            yield chunk
+        self.answer_cache.put(*cache_key, "".join(parts), retrieved_docs)
+
+    async def _acache_answer(
+        self, stream, cache_key: tuple, retrieved_docs
+    ) -> AsyncIterator:
+        parts = []
+        async for chunk in stream:
+            parts.append(str(chunk.content))
+            yield chunk
+        await asyncio.to_thread(
+            self.answer_cache.put, *cache_key, "".join(parts), retrieved_docs
+        )
+
+    def summarize(self, files: Sequence[FileItem], mode: str = "map_reduce"):
+        """Stream a summary of `files`.
+
+        Args:
+            files: Sources to summarize.
+            mode: "map_reduce" summarizes each source on its own, in parallel
+                and cached by content hash, then streams a combined summary.
+                "single" sends every file in one request.
+        """
+        if mode == "single":
+            return self._summarize_single(files)
+
+        summaries = self._summarize_sources(files)
+        combined = "\n\n".join(
+            f"## {item.title}\n{summaries[item.id]}" for item in files
         )
+        return self.model.stream([HumanMessage(content=COMBINE_PROMPT + combined)])
 
-    def summarize(self, files: Sequence[FileItem]):
+    def _summarize_single(self, files: Sequence[FileItem]):
         file_blocks = []
         for i in files:
             file_blocks += self.create_file_block(file_item=i)
 
-        prompt = """
-        You will be given one or more files (PDF, TXT, DOCX, Markdown, or other text-based formats). Your task is to produce a clear, accurate, and concise summary of the combined contents. Follow these rules:
-        Read all provided files and treat them as a unified information set.
-        Identify the key ideas, major topics, important data points, and recurring themes.
-        Do not include unnecessary detail—focus on essential information only.
-        Preserve meaning: ensure the summary reflects the original content without introducing new assumptions.
-        If the files contain multiple topics, organize the summary with logical sections or bullet points.
-        If any file is unreadable or empty, state this clearly but continue summarizing the rest.
-        IMPORTANT: If you reference any currency values or dollar amounts, you must escape all dollar signs by prefixing them with a backslash (\\$).
-        Example: write \\$1500 instead of $1500.
-        Apply this everywhere a dollar sign would appear, including inside code blocks.
-        Do not mention file formats unless relevant to content.
-        Output format:
-        A concise overall summary (1–3 paragraphs).
-        Followed by bullet-point highlights of the most important information.
-        All dollar signs escaped.
-        Begin once the files are provided.
-"""
-
         return self.model.stream(
             [
                 HumanMessage(
                     content_blocks=[  # type: ignore
-                        TextContentBlock(type="text", text=prompt),
+                        TextContentBlock(type="text", text=SUMMARY_PROMPT),
                     ]
                     + file_blocks
                 )
             ]
         )
+
+    def _summarize_sources(self, files: Sequence[FileItem]) -> dict[int, str]:
+        """Summarize each source, reusing summaries of unchanged content."""
+        model = self.model.model
+        summaries = {}
+        todo = []
+        for item in files:
+            cached = database.get_summary(item.blob_hash, model, SUMMARY_VERSION)
+            if cached is not None:
+                summaries[item.id] = cached
+            else:
+                todo.append(item)
+
+        with (
+            metrics.span("llm.summarize_map", sources=len(todo)),
+            ThreadPoolExecutor(max_workers=self.summary_concurrency) as pool,
+        ):
+            results = pool.map(self._summarize_source, todo)
+            for item, (summary, ok) in zip(todo, results):
+                summaries[item.id] = summary
+                if ok:
+                    database.save_summary(
+                        item.blob_hash, model, SUMMARY_VERSION, summary
+                    )
+
+        return summaries
+
+    def _summarize_source(self, item: FileItem) -> tuple[str, bool]:
+        """Map step for one source. Returns (summary, whether it may be cached)."""
+        with metrics.span("llm.summarize_source", source=item.id) as attrs:
+            try:
+                return self._source_summary(item), True
+            except Exception as e:
+                attrs["error"] = repr(e)
+                return f"This source could not be read ({type(e).__name__}).", False
+            finally:
+                # Pool threads each get their own scoped session
+                database.db_session.remove()
+
+    def _source_summary(self, item: FileItem) -> str:
+        mime_type = item.mime_type or mimetypes.guess_type(item.path)[0]
+        if mime_type in GEMINI_MIME_TYPES and mime_type != "text/plain":
+            # Images, audio, video and PDFs go to the model as they are
+            blocks = self.create_file_block(file_item=item)
+            response = self.model.invoke(
+                [
+                    HumanMessage(
+                        content_blocks=[  # type: ignore
+                            TextContentBlock(type="text", text=SOURCE_SUMMARY_PROMPT)
+                        ]
+                        + blocks
+                    )
+                ]
+            )
+            return str(response.content)
+
+        text = "\n\n".join(d.page_content for d in self.vector_store.source_text(item))
+        groups = [
+            text[i : i + self.summary_group_chars]
+            for i in range(0, len(text), self.summary_group_chars)
+        ] or [""]
+        if len(groups) > 1:
+            # Too big for one request: summarize each part, then the parts
+            partials = self.model.batch(
+                [SOURCE_SUMMARY_PROMPT + group for group in groups],
+                config={"max_concurrency": self.summary_concurrency},
+            )
+            groups = ["\n\n".join(str(p.content) for p in partials)]
+
+        response = self.model.invoke(SOURCE_SUMMARY_PROMPT + groups[0])
+        return str(response.content)
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import math
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Iterable, Iterator, Sequence
+
+from langchain_core.documents import Document
+
+
+def normalize_query(text: str) -> str:
+    """Case-fold and collapse whitespace so trivially different questions match."""
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+def source_set_key(versions: Iterable[tuple[int, str, int]]) -> str:
+    """Fingerprint of a set of sources in their current state.
+
+    `versions` are (id, blob_hash, indexed_chunks) triples. Replacing a
+    source's contents or finishing its indexing changes the key, so answers
+    cached against the old state stop matching.
+    """
+    parts = sorted(":".join(map(str, v)) for v in versions)
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+def _unit(vector: Sequence[float]) -> array:
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return array("f", (x / norm for x in vector))
+
+
+class AnswerCache:
+    """Persistent cache of generated answers, looked up by query similarity.
+
+    Answers are keyed on (model, source set key) and matched by the cosine
+    similarity of the normalized query's embedding, so rephrasings of the same
+    question against the same sources reuse one generation. Entries expire
+    after `ttl` seconds and the least recently used are evicted once there are
+    more than `max_entries`.
+    """
+
+    def __init__(
+        self,
+        path: str = "answer_cache.sqlite",
+        threshold: float = 0.95,
+        ttl: float = 24 * 60 * 60,
+        max_entries: int = 10_000,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS answer (
+                id INTEGER PRIMARY KEY,
+                model TEXT NOT NULL,
+                source_key TEXT NOT NULL,
+                query_vector BLOB NOT NULL,
+                response TEXT NOT NULL,
+                retrieved TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_answer_key ON answer (model, source_key)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_answer_last_used ON answer (last_used)"
+        )
+        self._conn.commit()
+
+    def get(
+        self, model: str, source_key: str, query_vector: Sequence[float]
+    ) -> tuple[str, list[tuple[Document, float]]] | None:
+        """Return the (response, retrieved docs) of the closest cached answer.
+
+        Only answers at least `threshold` similar to the query count as hits.
+        """
+        query = _unit(query_vector)
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, query_vector, response, retrieved FROM answer"
+                " WHERE model = ? AND source_key = ? AND created_at > ?",
+                (model, source_key, now - self.ttl),
+            )
+            best = None
+            best_score = self.threshold
+            for row in rows:
+                vector = array("f", row[1])
+                if len(vector) != len(query):
+                    continue
+                score = sum(a * b for a, b in zip(query, vector))
+                if score >= best_score:
+                    best, best_score = row, score
+
+            if best is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE answer SET last_used = ? WHERE id = ?", (now, best[0])
+            )
+            self._conn.commit()
+
+        retrieved = [
+            (Document(page_content=d["text"], metadata=d["metadata"]), d["score"])
+            for d in json.loads(best[3])
+        ]
+        return best[2], retrieved
+
+    def put(
+        self,
+        model: str,
+        source_key: str,
+        query_vector: Sequence[float],
+        response: str,
+        retrieved: Sequence[tuple[Document, float]],
+    ):
+        now = time.time()
+        retrieved_json = json.dumps(
+            [
+                {"text": d.page_content, "metadata": d.metadata, "score": score}
+                for d, score in retrieved
+            ],
+            default=str,
+        )
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO answer (model, source_key, query_vector, response,"
+                " retrieved, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    model,
+                    source_key,
+                    _unit(query_vector).tobytes(),
+                    response,
+                    retrieved_json,
+                    now,
+                    now,
+                ),
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now: float):
+        self._conn.execute(
+            "DELETE FROM answer WHERE created_at <= ?", (now - self.ttl,)
+        )
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM answer").fetchone()
+        if count <= self.max_entries:
+            return
+        # Trim a little below the cap so we don't evict on every insert
+        excess = count - int(self.max_entries * 0.9)
+        self._conn.execute(
+            "DELETE FROM answer WHERE id IN"
+            " (SELECT id FROM answer ORDER BY last_used LIMIT ?)",
+            (excess,),
+        )
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            (entries,) = self._conn.execute("SELECT COUNT(*) FROM answer").fetchone()
+            return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+
+def replay(response: str, chunk_chars: int = 40) -> Iterator[str]:
+    """Yield a cached response in small pieces, like a streamed generation."""
+    for i in range(0, len(response), chunk_chars):
+        yield response[i : i + chunk_chars]
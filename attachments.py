@@ -0,0 +1,151 @@
+"""Upload-once references to attachments in the provider's file storage.
+
+Sending a file inline puts its whole base64 in every request that uses it,
+so re-summarizing the same sources uploads them again each time and holds
+the encoded copy in memory. Instead, each distinct file is uploaded once and
+later requests reference it by URI. Handles are cached in the database by
+content hash with their expiry, and a file is uploaded again only once its
+handle is close to expiring.
+
+A file service provides `name`, `upload(file, mime_type, display_name)`
+returning a FileHandle, and `delete(name)`, as GeminiFileService does.
+"""
+
+import threading
+import time
+from contextlib import AbstractContextManager
+from typing import IO, Callable
+
+from google import genai
+from google.genai import types
+
+import database
+import metrics
+from database import FileHandle
+
+# Gemini keeps uploaded files for 48 hours
+GEMINI_FILE_TTL = 48 * 60 * 60
+
+
+class GeminiFileService:
+    """The Gemini Files API."""
+
+    name = "gemini"
+
+    def __init__(self, api_key: str, poll_seconds: float = 1.0):
+        self.client = genai.Client(api_key=api_key)
+        self.poll_seconds = poll_seconds
+
+    def upload(self, file: IO[bytes], mime_type: str, display_name: str) -> FileHandle:
+        uploaded = self.client.files.upload(
+            file=file,
+            config=types.UploadFileConfig(
+                mime_type=mime_type, display_name=display_name[:512]
+            ),
+        )
+        # Video and large PDFs are processed before they can be referenced
+        while uploaded.state == types.FileState.PROCESSING:
+            time.sleep(self.poll_seconds)
+            uploaded = self.client.files.get(name=uploaded.name)
+        if uploaded.state == types.FileState.FAILED:
+            raise RuntimeError(f"Gemini could not process {display_name}")
+
+        if uploaded.expiration_time is not None:
+            expires_at = uploaded.expiration_time.timestamp()
+        else:
+            expires_at = time.time() + GEMINI_FILE_TTL
+        return FileHandle(
+            name=uploaded.name,
+            uri=uploaded.uri,
+            mime_type=uploaded.mime_type or mime_type,
+            expires_at=expires_at,
+        )
+
+    def delete(self, name: str):
+        self.client.files.delete(name=name)
+
+
+class _UploadLock:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Threads uploading the blob or waiting for the upload
+        self.users = 0
+
+
+class AttachmentManager:
+    def __init__(
+        self,
+        service,
+        expiry_margin: float = 60 * 60,
+        inline_bytes: int = 256 * 1024,
+    ):
+        """
+        Args:
+            service: Where files are uploaded.
+            expiry_margin: Seconds before its expiry that a handle stops being
+                used, so a conversation never references a file mid-deletion.
+            inline_bytes: Files up to this size are cheaper to send inline
+                than to upload, and aren't uploaded.
+        """
+        self.service = service
+        self.expiry_margin = expiry_margin
+        self.inline_bytes = inline_bytes
+
+        self._lock = threading.Lock()
+        # blob hash -> lock held while uploading it, so concurrent requests
+        # for the same file upload it once
+        self._uploading: dict[str, _UploadLock] = {}
+
+    def should_upload(self, size: int) -> bool:
+        return size > self.inline_bytes
+
+    def handle(
+        self,
+        blob_hash: str,
+        mime_type: str,
+        open_file: Callable[[], AbstractContextManager[IO[bytes]]],
+        display_name: str,
+    ) -> FileHandle:
+        """A live handle to the blob, uploading it if there isn't one.
+
+        Args:
+            open_file: Opens the blob's contents, only called to upload it.
+        """
+        handle = self._cached(blob_hash)
+        if handle is not None:
+            return handle
+
+        with self._lock:
+            upload = self._uploading.setdefault(blob_hash, _UploadLock())
+            upload.users += 1
+        try:
+            with upload.lock:
+                # Another thread may have uploaded it while we waited
+                handle = self._cached(blob_hash)
+                if handle is not None:
+                    return handle
+                with metrics.span(
+                    "attachments.upload",
+                    service=self.service.name,
+                    mime_type=mime_type,
+                ):
+                    with open_file() as file:
+                        handle = self.service.upload(file, mime_type, display_name)
+                handle.blob_hash = blob_hash
+                handle.service = self.service.name
+                database.prune_file_handles(time.time())
+                database.save_file_handle(handle)
+                return handle
+        finally:
+            with self._lock:
+                # Only the last thread out removes the lock; removing it while
+                # others wait would let a newcomer upload the blob again
+                upload.users -= 1
+                if not upload.users:
+                    del self._uploading[blob_hash]
+
+    def _cached(self, blob_hash: str) -> FileHandle | None:
+        handle = database.get_file_handle(blob_hash, self.service.name)
+        if handle is None or handle.expires_at - self.expiry_margin <= time.time():
+            return None
+        return handle
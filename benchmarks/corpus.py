@@ -0,0 +1,85 @@
+"""Synthetic, seeded corpora for the benchmarks.
+
+Text is built from a fixed vocabulary with a Zipf-like word distribution, so
+both BM25 and the fake embeddings see realistic term overlap between
+documents and queries.
+"""
+
+import io
+import random
+
+# The default splitter makes a chunk every ~800 characters (1000 with 200 overlap)
+CHARS_PER_CHUNK = 800
+
+
+def vocabulary(size: int = 5000, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 10))))
+    return sorted(words)
+
+
+class TextGenerator:
+    def __init__(self, seed: int = 0, vocabulary_size: int = 5000):
+        self.rng = random.Random(seed)
+        self.words = vocabulary(vocabulary_size, seed)
+        # Zipf weights: the n-th most common word appears ~1/n as often
+        self.weights = [1 / n for n in range(1, len(self.words) + 1)]
+
+    def sentence(self) -> str:
+        words = self.rng.choices(self.words, self.weights, k=self.rng.randint(6, 20))
+        return " ".join(words).capitalize() + "."
+
+    def text(self, chars: int) -> str:
+        """Paragraphs of sentences totalling roughly `chars` characters."""
+        parts = []
+        size = 0
+        while size < chars:
+            paragraph = " ".join(self.sentence() for _ in range(self.rng.randint(3, 8)))
+            parts.append(paragraph)
+            size += len(paragraph) + 2
+        return "\n\n".join(parts)
+
+    def query(self) -> str:
+        return " ".join(self.rng.choices(self.words, self.weights, k=6)) + "?"
+
+
+class UploadedFile(io.BytesIO):
+    """In-memory file with the `name` and `type` Streamlit uploads carry."""
+
+    def __init__(self, data: bytes, name: str, type: str = "text/plain"):
+        super().__init__(data)
+        self.name = name
+        self.type = type
+
+
+def files_for_chunks(
+    generator: TextGenerator, chunks: int, files: int, pages_per_file: int = 10
+) -> list[UploadedFile]:
+    """`files` uploads that split into about `chunks` chunks in total."""
+    chars_per_page = max(1, chunks * CHARS_PER_CHUNK // (files * pages_per_file))
+    return [
+        UploadedFile(
+            "\f".join(
+                generator.text(chars_per_page) for _ in range(pages_per_file)
+            ).encode(),
+            name=f"doc-{n:05}.txt",
+        )
+        for n in range(files)
+    ]
+
+
+def html_pages(generator: TextGenerator, pages: int, chars: int) -> dict[str, str]:
+    """{path: html} for the fixture server, each page with nav boilerplate."""
+    return {
+        f"/page-{n:05}.html": (
+            f"<html lang='en'><head><title>Page {n}</title>"
+            f"<meta name='description' content='Synthetic page {n}'></head><body>"
+            "<nav>Home | About | Contact</nav>"
+            f"<article>{generator.text(chars)}</article>"
+            "<footer>Copyright</footer></body></html>"
+        )
+        for n in range(pages)
+    }
@@ -0,0 +1,223 @@
+"""Deterministic local stand-ins for Gemini, its file storage, LlamaParse and the web.
+
+Nothing here touches the network, so benchmarks measure our own code (and
+Chroma, SQLite and the splitter it drives) rather than API latency. Each fake
+can add a fixed delay to model the service it replaces.
+"""
+
+import hashlib
+import math
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Iterator
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+_TOKEN = re.compile(r"\w+")
+
+
+class FakeEmbeddings(Embeddings):
+    """Hashed bag-of-words vectors.
+
+    Texts sharing words get similar vectors, so similarity search returns
+    plausible neighbours and its cost matches a real index of this size.
+    """
+
+    def __init__(self, dimensions: int = 256, latency: float = 0.0):
+        self.dimensions = dimensions
+        self.latency = latency
+        self.calls = 0
+
+    def _embed(self, text: str) -> list[float]:
+        vector = [0.0] * self.dimensions
+        for token in _TOKEN.findall(text.lower()):
+            digest = hashlib.blake2b(token.encode(), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dimensions
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        self.calls += 1
+        time.sleep(self.latency)
+        return [self._embed(t) for t in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        self.calls += 1
+        time.sleep(self.latency)
+        return self._embed(text)
+
+
+class FakeChatModel(BaseChatModel):
+    """Answers with a fixed number of words derived from the prompt.
+
+    `first_token_latency` is slept before the first chunk and
+    `token_latency` between chunks, to model a streaming LLM.
+    """
+
+    model: str = "fake-chat"
+    answer_words: int = 200
+    first_token_latency: float = 0.0
+    token_latency: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _words(self, messages: list[BaseMessage]) -> list[str]:
+        seed = hashlib.sha256(
+            "".join(str(m.content) for m in messages).encode()
+        ).hexdigest()
+        return [f"w{seed[i % 60 : i % 60 + 4]}" for i in range(self.answer_words)]
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        time.sleep(self.first_token_latency + self.token_latency * self.answer_words)
+        text = " ".join(self._words(messages))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.first_token_latency)
+        for n, word in enumerate(self._words(messages)):
+            if n:
+                time.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word + " "))
+
+
+class FakeFileService:
+    """Gemini file storage stand-in that keeps uploads in memory.
+
+    `uploads` and `uploaded_bytes` count what was actually sent, and files
+    expire `ttl` seconds after upload, as Gemini's do after 48 hours. With
+    `fail` every upload raises, as when the service is down.
+    """
+
+    name = "fake-files"
+
+    def __init__(
+        self, ttl: float = 48 * 60 * 60, latency: float = 0.0, fail: bool = False
+    ):
+        self.ttl = ttl
+        self.latency = latency
+        self.fail = fail
+        self.files: dict[str, bytes] = {}
+        self.uploads = 0
+        self.uploaded_bytes = 0
+        self._lock = threading.Lock()
+
+    def upload(self, file, mime_type: str, display_name: str):
+        from database import FileHandle
+
+        time.sleep(self.latency)
+        if self.fail:
+            raise ConnectionError("file service unavailable")
+        data = file.read()
+        with self._lock:
+            self.uploads += 1
+            self.uploaded_bytes += len(data)
+            name = f"files/{self.uploads}"
+            self.files[name] = data
+        return FileHandle(
+            name=name,
+            uri=f"fake://{name}",
+            mime_type=mime_type,
+            expires_at=time.time() + self.ttl,
+        )
+
+    def delete(self, name: str):
+        with self._lock:
+            self.files.pop(name, None)
+
+
+class FakeParsedDocument:
+    """The parts of a LlamaIndex Document that VectorStoreHelper reads."""
+
+    def __init__(self, text: str, metadata: dict):
+        self.text = text
+        self.metadata = metadata
+
+
+class FakeParser:
+    """LlamaParse stand-in that decodes the file as UTF-8, one page per form feed."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+
+    def load_data(self, file, extra_info: dict | None = None):
+        self.calls += 1
+        time.sleep(self.latency)
+        text = file.read().decode(errors="replace")
+        return [
+            FakeParsedDocument(page, {**(extra_info or {}), "page_label": str(n)})
+            for n, page in enumerate(text.split("\f"), start=1)
+        ]
+
+
+class NullStatus:
+    """Stands in for a Streamlit status container."""
+
+    def update(self, label: str | None = None, **kwargs):
+        pass
+
+
+class FixtureServer:
+    """Serves `pages` ({path: html}) from a local threaded HTTP server.
+
+    Use as a context manager; `url(path)` gives the address of a page.
+    `latency` is slept before each response.
+    """
+
+    def __init__(self, pages: dict[str, str], latency: float = 0.0):
+        pages = {path: html.encode() for path, html in pages.items()}
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(latency)
+                body = pages.get(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="fixture-http", daemon=True
+        )
+
+    def url(self, path: str) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}{path}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,460 @@
+"""Run the offline benchmarks and save the results as JSON.
+
+    python -m benchmarks.run                      # every scenario, default sizes
+    python -m benchmarks.run -s search --chunks 100000
+    python -m benchmarks.run --compare old.json new.json
+
+Each scenario runs in a fresh interpreter inside its own temporary directory,
+so the app's SQLite files, blob store and Chroma directory start empty and
+peak RSS is measured per scenario. Gemini, its file storage, LlamaParse and the
+web are replaced with the fakes in benchmarks/fakes.py.
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from queue import Empty
+from typing import Callable
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, "benchmarks", "results")
+
+
+class Recorder:
+    """Collects per-operation latencies for one measured operation."""
+
+    def __init__(self):
+        self.samples: list[float] = []
+
+    def time(self, func: Callable, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.samples.append(time.perf_counter() - start)
+        return result
+
+    def summary(self, items_per_sample: float = 1) -> dict:
+        samples = sorted(self.samples)
+        total = sum(samples)
+        return {
+            "count": len(samples),
+            "p50_ms": _percentile(samples, 0.50) * 1000,
+            "p99_ms": _percentile(samples, 0.99) * 1000,
+            "mean_ms": total / len(samples) * 1000 if samples else 0.0,
+            "throughput_per_s": len(samples) * items_per_sample / total
+            if total
+            else 0.0,
+        }
+
+
+def _percentile(sorted_samples: list[float], q: float) -> float:
+    """Nearest-rank percentile."""
+    if not sorted_samples:
+        return 0.0
+    return sorted_samples[max(0, math.ceil(q * len(sorted_samples)) - 1)]
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def _make_agent(args):
+    """An Agent wired to the fakes. Must run inside the scenario's workdir."""
+    from agent import Agent
+    from benchmarks.fakes import (
+        FakeChatModel,
+        FakeEmbeddings,
+        FakeFileService,
+        FakeParser,
+    )
+    from embedding_writer import TokenBucket
+
+    agent = Agent("offline", "offline")
+    model = FakeChatModel(
+        first_token_latency=args.llm_latency, token_latency=args.token_latency
+    )
+    agent.model = agent.vector_store.model = model
+    agent.file_parser = agent.vector_store.parser = FakeParser(args.parse_latency)
+    agent.attachments.service = FakeFileService()
+    agent.vector_store.embeddings.embeddings = FakeEmbeddings(
+        latency=args.embedding_latency
+    )
+    agent.vector_store.writer.rate_limiter = TokenBucket(
+        rate=args.embedding_rpm / 60,
+        capacity=max(1, agent.vector_store.writer.max_in_flight),
+    )
+    return agent
+
+
+def _ingest_corpus(agent, args, generator):
+    from benchmarks.corpus import files_for_chunks
+    from benchmarks.fakes import NullStatus
+
+    files = files_for_chunks(generator, args.chunks, args.files)
+    items = agent.vector_store.add_files(files, NullStatus())
+    return items, sum(i.indexed_chunks for i in items)
+
+
+def bench_ingest_files(args) -> dict:
+    from benchmarks.corpus import TextGenerator, files_for_chunks
+    from benchmarks.fakes import NullStatus
+
+    agent = _make_agent(args)
+    generator = TextGenerator(args.seed)
+    files = files_for_chunks(generator, args.chunks, args.files)
+
+    first = Recorder()
+    items = first.time(agent.vector_store.add_files, files, NullStatus())
+    chunks = sum(i.indexed_chunks for i in items)
+
+    # Unchanged files: everything should be skipped by the chunk id diff
+    again = Recorder()
+    again.time(agent.vector_store.index_files, items, NullStatus())
+
+    return {
+        "chunks": chunks,
+        "files": len(files),
+        "seconds": first.samples[0],
+        "chunks_per_s": chunks / first.samples[0],
+        "reindex_unchanged_seconds": again.samples[0],
+    }
+
+
+def bench_ingest_urls(args) -> dict:
+    from benchmarks.corpus import TextGenerator, html_pages
+    from benchmarks.fakes import FixtureServer, NullStatus
+
+    agent = _make_agent(args)
+    pages = html_pages(TextGenerator(args.seed), args.pages, args.page_chars)
+    with FixtureServer(pages, latency=args.http_latency) as server:
+        urls = [server.url(path) for path in pages]
+        recorder = Recorder()
+        items = recorder.time(agent.vector_store.add_urls, urls, NullStatus())
+
+    seconds = recorder.samples[0]
+    return {
+        "pages": len(urls),
+        "added": len(items),
+        "seconds": seconds,
+        "pages_per_s": len(items) / seconds,
+    }
+
+
+def bench_search(args) -> dict:
+    from benchmarks.corpus import TextGenerator
+
+    agent = _make_agent(args)
+    generator = TextGenerator(args.seed)
+    items, chunks = _ingest_corpus(agent, args, generator)
+    src_ids = [i.id for i in items]
+    queries = [generator.query() for _ in range(args.queries)]
+
+    results = {"chunks": chunks}
+    for mode in ("vector", "lexical", "hybrid"):
+        for label, ids in (("all", None), ("filtered", src_ids[: len(src_ids) // 2])):
+            recorder = Recorder()
+            for query in queries:
+                recorder.time(
+                    agent.vector_store.similarity_search,
+                    query,
+                    k=4,
+                    src_ids=ids,
+                    mode=mode,
+                )
+            results[f"{mode}_{label}"] = recorder.summary()
+    return results
+
+
+def bench_new_prompt(args) -> dict:
+    from benchmarks.corpus import TextGenerator, UploadedFile
+
+    agent = _make_agent(args)
+    generator = TextGenerator(args.seed)
+    items, chunks = _ingest_corpus(agent, args, generator)
+    src_ids = {i.id for i in items}
+    queries = [generator.query() for _ in range(args.queries)]
+
+    def run(label: str, prompts: list[str], files_for=lambda: []):
+        stages: dict[str, list[float]] = {}
+        for query in prompts:
+            timings: dict[str, float] = {}
+            _, stream = agent.new_prompt(query, files_for(), src_ids, timings=timings)
+            for _ in stream:
+                pass
+            for stage, seconds in timings.items():
+                stages.setdefault(stage, []).append(seconds)
+        results[label] = {
+            stage: {
+                "p50_ms": _percentile(sorted(samples), 0.50) * 1000,
+                "p99_ms": _percentile(sorted(samples), 0.99) * 1000,
+            }
+            for stage, samples in stages.items()
+        }
+
+    results: dict = {"chunks": chunks, "prompts": len(queries)}
+    run("uncached", queries)
+    # The same questions again, answered from the answer cache
+    run("cached", queries)
+
+    attachments = [
+        UploadedFile(generator.text(20_000).encode(), name=f"attachment-{n}.docx")
+        for n in range(args.attachments)
+    ]
+    run(
+        f"with_{len(attachments)}_attachments",
+        queries[: max(1, len(queries) // 10)],
+        lambda: attachments,
+    )
+    return results
+
+
+def bench_attachments(args) -> dict:
+    """Concurrent prompts attaching the same large file, then a failed upload.
+
+    Checks the behavior too: the file must be uploaded once and referenced
+    by every prompt, and a failed upload must fall back to sending it inline.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from benchmarks.corpus import TextGenerator, UploadedFile
+    from benchmarks.fakes import FakeFileService
+
+    agent = _make_agent(args)
+    # Slow enough that concurrent prompts wait on the same upload
+    service = agent.attachments.service = FakeFileService(latency=0.05)
+    generator = TextGenerator(args.seed)
+    size = agent.attachments.inline_bytes * 4
+    data = generator.text(size).encode()
+
+    def attach(n: int):
+        file = UploadedFile(data, name=f"shared-{n}.pdf", type="application/pdf")
+        return agent.create_file_block(file)
+
+    results: dict = {}
+    for label in ("first_use", "cached"):
+        recorder = Recorder()
+        prompts = max(2, args.attachments * 4)
+        with ThreadPoolExecutor(max_workers=prompts) as pool:
+            blocks = list(pool.map(lambda n: recorder.time(attach, n), range(prompts)))
+        file_ids = {block.get("file_id") for [block] in blocks}
+        if service.uploads != 1 or len(file_ids) != 1 or None in file_ids:
+            raise AssertionError(
+                f"{prompts} prompts made {service.uploads} uploads "
+                f"referenced as {file_ids}"
+            )
+        results[label] = recorder.summary()
+    results["uploaded_bytes"] = service.uploaded_bytes
+
+    agent.attachments.service = FakeFileService(fail=True)
+    other = UploadedFile(
+        generator.text(size).encode(), name="other.pdf", type="application/pdf"
+    )
+    recorder = Recorder()
+    [block] = recorder.time(agent.create_file_block, other)
+    if "base64" not in block:
+        raise AssertionError("a failed upload wasn't sent inline")
+    results["failed_upload"] = recorder.summary()
+    return results
+
+
+def bench_chat(args) -> dict:
+    import database
+    from benchmarks.corpus import TextGenerator
+
+    generator = TextGenerator(args.seed)
+    chat = database.new_chat(title="benchmark")
+    sources = [
+        database.FileItem.from_file(
+            generator.text(1000).encode(),
+            title=f"source-{n}",
+            path=f"source-{n}.txt",
+            type=database.SourceType.FILE,
+        )
+        for n in range(20)
+    ]
+    database.db_session.add_all(sources)
+    database.db_session.commit()
+    chat.add_enabled_sources(sources)
+
+    # Bulk load the history; this part isn't what is being measured
+    sentences = [generator.sentence() for _ in range(1000)]
+    for start in range(0, args.messages, 10_000):
+        database.db_session.add_all(
+            database.Message(
+                chat_id=chat.id,
+                author="user" if n % 2 else "assistant",
+                text=sentences[n % len(sentences)],
+            )
+            for n in range(start, min(start + 10_000, args.messages))
+        )
+        database.db_session.commit()
+
+    results: dict = {"messages": args.messages}
+    operations = {
+        "page_messages": lambda: chat.page_messages(limit=50),
+        "message_count": chat.message_count,
+        "enabled_source_ids": lambda: chat.enabled_source_ids,
+        "enabled_sources": lambda: chat.enabled_sources,
+        "add_message": lambda: chat.add_message(
+            "user", generator.sentence(), source_ids=[sources[0].id]
+        ),
+    }
+    for name, operation in operations.items():
+        recorder = Recorder()
+        for _ in range(args.repeats):
+            recorder.time(operation)
+        results[name] = recorder.summary()
+
+    recorder = Recorder()
+    for _ in range(3):
+        recorder.time(lambda: chat.messages)
+    results["all_messages"] = recorder.summary()
+    return results
+
+
+SCENARIOS = {
+    "ingest_files": bench_ingest_files,
+    "ingest_urls": bench_ingest_urls,
+    "search": bench_search,
+    "new_prompt": bench_new_prompt,
+    "attachments": bench_attachments,
+    "chat": bench_chat,
+}
+
+
+def _run_scenario(name: str, args, queue):
+    workdir = tempfile.mkdtemp(prefix=f"bench-{name}-")
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    # Keep span logs out of the results; the histograms still work
+    import logging
+
+    logging.getLogger("metrics").setLevel(logging.WARNING)
+
+    start = time.perf_counter()
+    try:
+        result = SCENARIOS[name](args)
+        result["wall_seconds"] = time.perf_counter() - start
+        result["peak_rss_mb"] = _peak_rss_mb()
+        queue.put((name, result))
+    except BaseException as e:
+        queue.put((name, {"error": f"{type(e).__name__}: {e}"}))
+        raise
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> dict:
+    # spawn, not fork: every scenario gets fresh module state and its own RSS
+    context = multiprocessing.get_context("spawn")
+    report = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {k: v for k, v in vars(args).items() if k != "compare"},
+        "scenarios": {},
+    }
+    for name in args.scenario or SCENARIOS:
+        queue = context.Queue()
+        process = context.Process(target=_run_scenario, args=(name, args, queue))
+        process.start()
+        while True:
+            try:
+                _, result = queue.get(timeout=1)
+                break
+            except Empty:
+                if not process.is_alive():
+                    result = {"error": f"exited with code {process.exitcode}"}
+                    break
+        process.join()
+        report["scenarios"][name] = result
+        print(f"{name}: {json.dumps(result, indent=2)}")
+    return report
+
+
+def _flatten(data, prefix="") -> dict[str, float]:
+    flat = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(old_path: str, new_path: str):
+    """Print every numeric result side by side with the relative change."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    before = _flatten(old["scenarios"])
+    after = _flatten(new["scenarios"])
+    print(f"{'metric':60} {old.get('commit')!s:>12} {new.get('commit')!s:>12}  change")
+    for key in sorted(before.keys() & after.keys()):
+        a, b = before[key], after[key]
+        change = f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+        print(f"{key:60} {a:12.3f} {b:12.3f}  {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-s", "--scenario", action="append", choices=sorted(SCENARIOS))
+    parser.add_argument("--chunks", type=int, default=1000)
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--pages", type=int, default=50)
+    parser.add_argument("--page-chars", type=int, default=20_000)
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--attachments", type=int, default=3)
+    parser.add_argument("--repeats", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--embedding-rpm",
+        type=float,
+        default=1e9,
+        help="Embedding request rate limit. Unlimited by default so results "
+        "reflect our code rather than the quota",
+    )
+    parser.add_argument("--embedding-latency", type=float, default=0.0)
+    parser.add_argument("--parse-latency", type=float, default=0.0)
+    parser.add_argument("--llm-latency", type=float, default=0.0)
+    parser.add_argument("--token-latency", type=float, default=0.0)
+    parser.add_argument("--http-latency", type=float, default=0.0)
+    parser.add_argument("-o", "--output", help="Where to write the JSON report")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = run(args)
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{report['commit'] or 'unknown'}-{int(time.time())}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import hashlib
+import mmap
+import os
+import tempfile
+from typing import IO
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class BlobStore:
+    """Content-addressed file storage keyed by the SHA-256 of the contents.
+
+    Blobs live at `<root>/<first two hex chars>/<full hex digest>`, so
+    identical uploads are written once no matter how many rows point at them.
+    """
+
+    def __init__(self, root: str = "blobs"):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def put(self, data: bytes | IO[bytes]) -> tuple[str, int]:
+        """Store `data` and return its (sha256 hex digest, size in bytes).
+
+        File objects are streamed in chunks from their current position, so
+        large uploads are never held in memory all at once.
+        """
+        hasher = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".incoming-")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                if isinstance(data, (bytes, bytearray, memoryview)):
+                    hasher.update(data)
+                    tmp.write(data)
+                    size = len(data)
+                else:
+                    while chunk := data.read(CHUNK_SIZE):
+                        hasher.update(chunk)
+                        tmp.write(chunk)
+                        size += len(chunk)
+
+            digest = hasher.hexdigest()
+            final_path = self.path(digest)
+            if os.path.exists(final_path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                os.replace(tmp_path, final_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        return digest, size
+
+    def open(self, digest: str) -> IO[bytes]:
+        return open(self.path(digest), "rb")
+
+    def read(self, digest: str) -> bytes:
+        with self.open(digest) as f:
+            return f.read()
+
+    def mmap(self, digest: str) -> mmap.mmap:
+        """Memory-map a blob read-only. The caller is responsible for closing it.
+
+        Raises ValueError for empty blobs, which cannot be mapped.
+        """
+        with self.open(digest) as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def delete(self, digest: str):
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
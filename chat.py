@@ -5,7 +5,16 @@ import validators
 from streamlit.runtime.uploaded_file_manager import UploadedFile
 
 from agent import Agent
-from database import Chat, FileItem, SourceType, db_session, get_sources
+from database import (
+    Chat,
+    FileItem,
+    JobState,
+    SourceType,
+    get_sources,
+)
+from jobs import JobQueue, active_jobs, describe_job, dismiss_job
+
+HISTORY_PAGE_SIZE = 50
 
 
 def validate_url(url: str):
@@ -24,9 +33,38 @@ def validate_url(url: str):
     return url
 
 
-def _page(chat: Chat, agent: Agent):
-    def source_widget(item: FileItem):
-        enabled = item in chat.enabled_sources
+class ChatView:
+    """What the chat page reads from the database, loaded once per run.
+
+    Two queries fetch every source (FileItem rows only hold metadata; the
+    contents live in the blob store) and the chat's enabled source ids.
+    Widgets check and update `enabled_ids` instead of querying the chat's
+    enabled sources for each source they draw.
+    """
+
+    def __init__(self, chat: Chat):
+        self.chat = chat
+        self.sources = get_sources()
+        self.enabled_ids = chat.enabled_source_ids
+
+    @property
+    def enabled_sources(self) -> list[FileItem]:
+        return [i for i in self.sources if i.id in self.enabled_ids]
+
+    def enable(self, item: FileItem):
+        self.chat.add_enabled_sources([item])
+        self.enabled_ids.add(item.id)
+
+    def disable(self, item: FileItem):
+        self.chat.remove_enabled_sources([item])
+        self.enabled_ids.discard(item.id)
+
+
+def _page(chat: Chat, agent: Agent, jobs: JobQueue):
+    view = ChatView(chat)
+
+    def source_widget(view: ChatView, item: FileItem):
+        enabled = item.id in view.enabled_ids
         with st.container(
             key=f"source_item_{item.id}",
             border=True,
@@ -36,18 +74,16 @@ def _page(chat: Chat, agent: Agent):
                 horizontal=True, gap="medium", horizontal_alignment="distribute"
             ):
                 # Checkbox for enabling/disabling the source
-                if (
-                    st.checkbox(
-                        "-",
-                        value=enabled,
-                        key=f"source-{item.id}-enabled",
-                        label_visibility="hidden",
-                    )
-                    and not enabled
-                ):
-                    chat.add_enabled_sources([item])
-                elif enabled:
-                    chat.remove_enabled_sources([item])
+                checked = st.checkbox(
+                    "-",
+                    value=enabled,
+                    key=f"source-{item.id}-enabled",
+                    label_visibility="hidden",
+                )
+                if checked and not enabled:
+                    view.enable(item)
+                elif enabled and not checked:
+                    view.disable(item)
 
                 st.markdown(f"### {item.title}", width="content")
 
@@ -58,10 +94,7 @@ def _page(chat: Chat, agent: Agent):
                     help="Remove source",
                     key=f"remove_source_{item.id}",
                 ):
-                    db_session.delete(item)
-                    if item in chat.enabled_sources:
-                        chat.remove_enabled_sources([item])
-                    db_session.commit()
+                    agent.vector_store.delete_source(item)
                     st.rerun(scope="fragment")
 
             # Display the path of the source below the controls
@@ -70,9 +103,11 @@ def _page(chat: Chat, agent: Agent):
     @st.fragment()
     @st.dialog(title="Add Sources", width="large")
     def sources_dialog():
+        # The dialog reruns on its own, so it loads its own view
+        view = ChatView(chat)
         urls = []
         files = []
-        for i in get_sources():
+        for i in view.sources:
             if i.type == SourceType.FILE:
                 files.append(i)
             elif i.type == SourceType.WEBPAGE:
@@ -86,21 +121,19 @@ def _page(chat: Chat, agent: Agent):
                 accept_multiple_files=True,
                 key="new_source_file",
             ):
-                with st.status("Adding file to sources") as status:
-                    # Merge FileItem objects into the session before adding
-                    chat.add_enabled_sources(
-                        agent.vector_store.add_files(src_files, status)
-                    )
-
-                    db_session.merge(chat)
-                    db_session.commit()
-                    status.update(label="File added as a source")
+                # The uploader keeps its files across reruns, so only queue
+                # the ones we haven't seen yet
+                queued = st.session_state.setdefault("queued_uploads", set())
+                if new_files := [i for i in src_files if i.file_id not in queued]:
+                    jobs.enqueue_files(chat, new_files)
+                    queued.update(i.file_id for i in new_files)
+                    st.toast(f"Indexing {len(new_files)} file(s) in the background")
 
             with st.container(
                 height=200, border=False, horizontal_alignment="distribute"
             ):
                 for i in files:
-                    source_widget(i)
+                    source_widget(view, i)
 
         with right:
             st.subheader("URLs")
@@ -115,29 +148,38 @@ def _page(chat: Chat, agent: Agent):
                 key="new_source_url",
             ):
                 if url := validate_url(src_url):
-                    with st.status("Adding URL to sources") as status:
-                        st.session_state.should_clear_url_field = True
-
-                        new_sources = agent.vector_store.add_urls([url], status)
-                        chat.enabled_sources += new_sources
-                        db_session.merge(chat)
-                        db_session.commit()
-
-                        status.update(label="URL added as a source")
-                        st.rerun(scope="fragment")
-
+                    st.session_state.should_clear_url_field = True
+                    jobs.enqueue_urls(chat, [url])
+                    st.toast("Indexing URL in the background")
+                    st.rerun(scope="fragment")
                 else:
                     st.error("Incorrect URL format.")
             st.space()
             with st.container(height=200, border=False):
                 for i in urls:
-                    source_widget(i)
+                    source_widget(view, i)
+
+    @st.fragment(run_every="2s")
+    def ingest_status():
+        for job in active_jobs(chat.id):
+            with st.container(horizontal=True, vertical_alignment="center"):
+                if job.state == JobState.FAILED:
+                    st.error(f"Could not index {describe_job(job)}: {job.error}")
+                    if st.button(
+                        "", icon=":material/close:", key=f"dismiss_job_{job.id}"
+                    ):
+                        dismiss_job(job)
+                        st.rerun(scope="fragment")
+                else:
+                    st.caption(
+                        f":material/sync: Indexing {describe_job(job)}: {job.progress}"
+                    )
 
     st.title("Ask away")
 
     with st.container(horizontal=True, horizontal_alignment="distribute"):
-        num_sources = len(get_sources())
-        num_enabled_sources = len(chat.enabled_sources)
+        num_sources = len(view.sources)
+        num_enabled_sources = len(view.enabled_sources)
         if st.button(
             f"{num_enabled_sources}/{num_sources} sources enabled. Click to add/manage sources"
         ):
@@ -145,7 +187,18 @@ def _page(chat: Chat, agent: Agent):
 
         st.button(f"Summarize {num_enabled_sources}", key="summarize_button")
 
-    st.session_state.messages = chat.messages
+    ingest_status()
+
+    history_key = f"history_limit_{chat.id}"
+    if history_key not in st.session_state:
+        st.session_state[history_key] = HISTORY_PAGE_SIZE
+
+    st.session_state.messages = chat.page_messages(limit=st.session_state[history_key])
+
+    if len(st.session_state.messages) < chat.message_count():
+        if st.button("Load earlier messages", type="tertiary"):
+            st.session_state[history_key] += HISTORY_PAGE_SIZE
+            st.rerun()
 
     for message in st.session_state.messages:
         with st.chat_message(message.author):
@@ -166,7 +219,10 @@ def _page(chat: Chat, agent: Agent):
         with st.chat_message("user"):
             st.markdown(prompt)
 
-        retrieved_docs, response = agent.new_prompt(prompt, files)
+        # Each stage's timing is logged as a prompt.* span
+        retrieved_docs, response = agent.new_prompt(
+            prompt, files, src_ids=view.enabled_ids
+        )
 
         with st.chat_message("assistant"):
             full_response = st.write_stream(response)
@@ -197,7 +253,7 @@ def _page(chat: Chat, agent: Agent):
             st.session_state.messages.append(msg)
 
     if st.session_state.get("summarize_button", None):
-        enabled_sources = chat.enabled_sources
+        enabled_sources = view.enabled_sources
         with st.chat_message("user"):
             msg = chat.add_message(
                 "user",
@@ -209,7 +265,7 @@ def _page(chat: Chat, agent: Agent):
             st.markdown(f"Summarize these sources: {','.join(source_titles)}")
 
         with st.chat_message("assistant"):
-            full_response = st.write_stream(agent.summarize(chat.enabled_sources))
+            full_response = st.write_stream(agent.summarize(enabled_sources))
             msg = chat.add_message(
                 "assistant",
                 str(full_response),
@@ -218,9 +274,9 @@ def _page(chat: Chat, agent: Agent):
             st.session_state.messages.append(msg)
 
 
-def chat_page(chat: Chat, agent: Agent):
+def chat_page(chat: Chat, agent: Agent, jobs: JobQueue):
     return st.Page(
-        partial(_page, chat=chat, agent=agent),
+        partial(_page, chat=chat, agent=agent, jobs=jobs),
         title=chat.title,
         url_path=f"chat-{chat.id}",
     )
@@ -0,0 +1,217 @@
+"""Assemble retrieved chunks and attachments into a prompt of bounded size.
+
+Tokens are estimated locally from character counts, so budgeting costs
+nothing. Retrieved chunks of the same source and page that overlap or touch
+are merged back into one passage using their `start`/`end` offsets, which
+removes the splitter's repeated overlap. Passages are then kept best first
+until the budget runs out; the one that doesn't fit is trimmed and the rest
+are dropped.
+
+Large text attachments are cut down similarly: split, ranked against the
+query with BM25, and only the best chunks that fit sent, merged where they
+touch and in document order. A PDF's size is judged by its page count, so
+one that fits is sent whole without being parsed first.
+"""
+
+import math
+import re
+from collections import Counter
+from typing import NamedTuple, Sequence
+
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+# Rough characters per token for English text, for budgeting without a tokenizer
+CHARS_PER_TOKEN = 4
+
+# A trimmed passage shorter than this isn't worth including
+MIN_TRIMMED_TOKENS = 50
+
+# Gemini reads a PDF natively at a flat cost per page
+PDF_PAGE_TOKENS = 258
+
+_PDF_PAGE = re.compile(rb"/Type\s*/Page(?![A-Za-z])")
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, -(-len(text) // CHARS_PER_TOKEN))
+
+
+def pdf_pages(data: bytes) -> int | None:
+    """Count the pages of a PDF from its page objects, without parsing it.
+
+    None if they can't be counted this way, as when the page objects are in
+    compressed object streams.
+    """
+    return len(_PDF_PAGE.findall(data)) or None
+
+
+class Passage(NamedTuple):
+    doc: Document
+    score: float
+    # Ids of the retrieved chunks merged into this passage
+    chunk_ids: list[str]
+
+
+def _span_key(doc: Document) -> tuple:
+    return doc.metadata.get("src_id"), doc.metadata.get("page")
+
+
+def merge_adjacent(retrieved: Sequence[tuple[Document, float]]) -> list[Passage]:
+    """Merge chunks of one source and page whose offsets overlap or touch.
+
+    A merged passage keeps the best score of its chunks. Chunks without
+    offsets are passed through unchanged. Returns passages best first.
+    """
+    groups: dict[tuple, list[tuple[Document, float]]] = {}
+    passages = []
+    for doc, score in retrieved:
+        start, end = doc.metadata.get("start"), doc.metadata.get("end")
+        if start is None or end is None:
+            passages.append(Passage(doc, score, [doc.id]))
+        else:
+            groups.setdefault(_span_key(doc), []).append((doc, score))
+
+    for chunks in groups.values():
+        chunks.sort(key=lambda c: c[0].metadata["start"])
+        doc, score = chunks[0]
+        text, start, end = doc.page_content, doc.metadata["start"], doc.metadata["end"]
+        metadata, ids = doc.metadata, [doc.id]
+        for doc, next_score in chunks[1:]:
+            next_start, next_end = doc.metadata["start"], doc.metadata["end"]
+            if next_start <= end:
+                # Only append the part past what we already have
+                text += doc.page_content[end - next_start :]
+                end = max(end, next_end)
+                score = max(score, next_score)
+                ids.append(doc.id)
+                continue
+            passages.append(_passage(text, metadata, start, end, score, ids))
+            text, start, end = doc.page_content, next_start, next_end
+            metadata, score, ids = doc.metadata, next_score, [doc.id]
+        passages.append(_passage(text, metadata, start, end, score, ids))
+
+    passages.sort(key=lambda p: p.score, reverse=True)
+    return passages
+
+
+def _passage(text, metadata, start, end, score, ids) -> Passage:
+    doc = Document(page_content=text, metadata={**metadata, "start": start, "end": end})
+    return Passage(doc, score, ids)
+
+
+def trim_to_tokens(text: str, tokens: int) -> str:
+    """Cut `text` to about `tokens`, at a sentence or word boundary if possible."""
+    limit = tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    boundary = max(cut.rfind(". "), cut.rfind("\n"))
+    if boundary < limit // 2:
+        boundary = cut.rfind(" ")
+    return cut[: boundary + 1 if boundary > 0 else limit].rstrip() + " …"
+
+
+class Context(NamedTuple):
+    passages: list[Passage]
+    tokens: int
+    # Chunk ids that didn't fit at all, and those only partly included
+    dropped: list[str]
+    trimmed: list[str]
+
+
+def build_context(
+    retrieved: Sequence[tuple[Document, float]], budget: int | None
+) -> Context:
+    """Merge `retrieved` and keep the best passages within `budget` tokens."""
+    passages = merge_adjacent(retrieved)
+    kept, dropped, trimmed = [], [], []
+    used = 0
+    for passage in passages:
+        tokens = estimate_tokens(passage.doc.page_content)
+        remaining = None if budget is None else budget - used
+        if remaining is None or tokens <= remaining:
+            kept.append(passage)
+            used += tokens
+        elif remaining >= MIN_TRIMMED_TOKENS:
+            text = trim_to_tokens(passage.doc.page_content, remaining)
+            doc = Document(page_content=text, metadata=passage.doc.metadata)
+            kept.append(passage._replace(doc=doc))
+            used += estimate_tokens(text)
+            trimmed += passage.chunk_ids
+        else:
+            dropped += passage.chunk_ids
+    return Context(kept, used, dropped, trimmed)
+
+
+def _bm25(query: str, chunks: Sequence[str], k1: float = 1.2, b: float = 0.75):
+    terms = set(t.lower() for t in _TOKEN.findall(query))
+    counts = [Counter(t.lower() for t in _TOKEN.findall(c)) for c in chunks]
+    lengths = [sum(c.values()) for c in counts]
+    average = sum(lengths) / len(lengths) if lengths else 0
+    frequency = {t: sum(1 for c in counts if t in c) for t in terms}
+    scores = []
+    for count, length in zip(counts, lengths):
+        score = 0.0
+        for term in terms:
+            tf = count.get(term, 0)
+            if not tf:
+                continue
+            idf = math.log(
+                1 + (len(chunks) - frequency[term] + 0.5) / (frequency[term] + 0.5)
+            )
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average))
+        scores.append(score)
+    return scores
+
+
+def excerpts(docs: Sequence[Document], query: str, budget: int) -> str:
+    """The parts of `docs` most relevant to `query`, within `budget` tokens.
+
+    Excerpts are listed in document order, each with its page, and merged
+    where they touch.
+    """
+    # Small enough that a few excerpts always fit
+    chunk_size = max(100, min(1000, budget * CHARS_PER_TOKEN // 4))
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=0, add_start_index=True
+    )
+    chunks = []
+    for n, doc in enumerate(docs):
+        for chunk in splitter.split_documents([doc]):
+            start = chunk.metadata["start_index"]
+            chunk.metadata = {
+                "src_id": 0,
+                "page": doc.metadata.get("page_label") or n + 1,
+                "start": start,
+                "end": start + len(chunk.page_content),
+                "order": n,
+            }
+            chunk.id = f"{n}:{start}"
+            chunks.append(chunk)
+    if not chunks:
+        return ""
+
+    scores = _bm25(query, [c.page_content for c in chunks])
+    # Earlier chunks win ties, so an unrelated query still gets the opening
+    ranked = sorted(
+        zip(chunks, scores),
+        key=lambda c: (-c[1], c[0].metadata["order"], c[0].metadata["start"]),
+    )
+    # Pick whole chunks first; merging before picking would join the whole
+    # document into one passage, as chunks without overlap all touch
+    picked, used = [], 0
+    for chunk, score in ranked:
+        tokens = estimate_tokens(chunk.page_content)
+        if used + tokens <= budget:
+            picked.append((chunk, score))
+            used += tokens
+    passages = sorted(
+        merge_adjacent(picked),
+        key=lambda p: (p.doc.metadata["order"], p.doc.metadata["start"]),
+    )
+    return "\n[…]\n".join(
+        f"(page {p.doc.metadata['page']})\n{p.doc.page_content}" for p in passages
+    )
@@ -0,0 +1,460 @@
+"""Near-duplicate chunk detection with MinHash and locality-sensitive hashing.
+
+Each chunk is reduced to a MinHash signature of its word shingles, whose
+positions agree with another signature's in proportion to the Jaccard
+similarity of the two chunks. Signatures are split into bands and hashed, so
+likely matches are found by looking up band keys instead of comparing
+against every stored chunk, then confirmed against the full signature.
+
+A chunk at least `threshold` similar to one already indexed for the same
+tenant isn't embedded. It is recorded as a duplicate of that chunk instead,
+with its own text and metadata, so retrieval can stand the original in for
+it and the duplicate can take its place if the original is deleted.
+"""
+
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+from collections import defaultdict
+from typing import Iterable, NamedTuple, Sequence
+
+import numpy as np
+from langchain_core.documents import Document
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def _hash32(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=4).digest(), "little")
+
+
+def _band_params(
+    threshold: float, num_perm: int, recall: float = 0.99
+) -> tuple[int, int]:
+    """(bands, rows) so that pairs `threshold` similar share a band with
+    probability at least `recall`.
+
+    A pair with Jaccard similarity s shares at least one band with probability
+    1 - (1 - s^rows)^bands. More rows per band make dissimilar pairs less
+    likely to become candidates, so this picks the most rows that still meet
+    `recall` at `threshold`. Permutations left over after the last full band
+    are unused.
+    """
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        if 1 - (1 - threshold**rows) ** bands >= recall:
+            best = (bands, rows)
+    return best
+
+
+class Duplicate(NamedTuple):
+    """A chunk that was collapsed into another instead of being indexed."""
+
+    chunk_id: str
+    tenant: str
+    document: Document
+
+
+class DedupBatch:
+    """Chunks classified during one ingestion, saved once they are indexed.
+
+    Originals found here are matched against the rest of the batch as well
+    as the index, so a document uploaded twice in one batch is still only
+    embedded once.
+    """
+
+    def __init__(self, index: "NearDuplicateIndex"):
+        self.index = index
+        # (chunk_id, tenant, src_id, signature)
+        self.originals: list[tuple[str, str, int, np.ndarray]] = []
+        # (chunk_id, tenant, src_id, original_id, original_src_id, similarity, doc)
+        self.duplicates: list[tuple] = []
+        self.collapsed = 0
+        self.saved_chars = 0
+        self._buckets: dict[tuple[str, int, int], list[int]] = defaultdict(list)
+
+    def classify(self, doc: Document, tenant: str) -> bool:
+        """Record `doc` as an original or a duplicate. True if it's a duplicate."""
+        signature = self.index.signature(doc.page_content)
+        if signature is None:
+            return False
+
+        keys = self.index.band_keys(signature)
+        match = self._match(tenant, signature, keys)
+        if match is None:
+            self.add_original(doc, tenant, signature, keys)
+            return False
+
+        original_id, original_src_id, similarity = match
+        self.add_duplicate(doc, tenant, original_id, original_src_id, similarity)
+        self.collapsed += 1
+        self.saved_chars += len(doc.page_content)
+        return True
+
+    def add_original(
+        self,
+        doc: Document,
+        tenant: str,
+        signature: np.ndarray | None = None,
+        keys: list[int] | None = None,
+    ):
+        """Register an indexed chunk so later chunks can match it."""
+        if signature is None:
+            signature = self.index.signature(doc.page_content)
+            if signature is None:
+                return
+            keys = self.index.band_keys(signature)
+        n = len(self.originals)
+        self.originals.append((doc.id, tenant, doc.metadata.get("src_id"), signature))
+        for band, key in enumerate(keys):
+            self._buckets[(tenant, band, key)].append(n)
+
+    def add_duplicate(
+        self,
+        doc: Document,
+        tenant: str,
+        original_id: str,
+        original_src_id: int,
+        similarity: float,
+    ):
+        self.duplicates.append(
+            (
+                doc.id,
+                tenant,
+                doc.metadata.get("src_id"),
+                original_id,
+                original_src_id,
+                similarity,
+                doc,
+            )
+        )
+
+    def _match(
+        self, tenant: str, signature: np.ndarray, keys: list[int]
+    ) -> tuple[str, int, float] | None:
+        best = None
+        best_similarity = self.index.threshold
+        pending = {
+            n
+            for band, key in enumerate(keys)
+            for n in self._buckets[(tenant, band, key)]
+        }
+        candidates = [self.originals[n] for n in pending]
+        candidates += self.index.candidates(tenant, keys)
+        for chunk_id, _, src_id, other in candidates:
+            similarity = float(np.mean(signature == other))
+            if similarity >= best_similarity:
+                best, best_similarity = (chunk_id, src_id), similarity
+        if best is None:
+            return None
+        return best[0], best[1], best_similarity
+
+
+class NearDuplicateIndex:
+    """Persistent MinHash LSH index over the chunks stored in the vector store.
+
+    Backed by SQLite like the lexical index. Only chunks of the same tenant
+    are compared, so no tenant's chunks ever stand in for another's.
+    """
+
+    def __init__(
+        self,
+        path: str = "dedup_index.sqlite",
+        threshold: float = 0.9,
+        num_perm: int = 128,
+        shingle_words: int = 3,
+        seed: int = 1,
+    ):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_words = shingle_words
+        self.bands, self.rows = _band_params(threshold, num_perm)
+
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, _MERSENNE_PRIME, num_perm, dtype=np.uint64)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS signature (
+                chunk_id TEXT PRIMARY KEY,
+                tenant TEXT NOT NULL,
+                src_id INTEGER,
+                signature BLOB NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS band (
+                tenant TEXT NOT NULL,
+                band INTEGER NOT NULL,
+                key INTEGER NOT NULL,
+                chunk_id TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_band_key ON band (tenant, band, key);
+            CREATE INDEX IF NOT EXISTS ix_band_chunk ON band (chunk_id);
+            CREATE TABLE IF NOT EXISTS duplicate (
+                chunk_id TEXT PRIMARY KEY,
+                tenant TEXT NOT NULL,
+                src_id INTEGER,
+                original_id TEXT NOT NULL,
+                original_src_id INTEGER,
+                similarity REAL NOT NULL,
+                text TEXT NOT NULL,
+                metadata TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_duplicate_src ON duplicate (src_id);
+            CREATE INDEX IF NOT EXISTS ix_duplicate_original ON duplicate (original_id);
+            CREATE TABLE IF NOT EXISTS info (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            """
+        )
+        self._conn.commit()
+        self._check_banding()
+
+    def signature(self, text: str) -> np.ndarray | None:
+        """MinHash signature of the word shingles of `text`.
+
+        None for text too short to have a shingle, which is never deduplicated.
+        """
+        tokens = [t.lower() for t in _TOKEN.findall(text)]
+        n = self.shingle_words
+        if len(tokens) < n:
+            return None
+        shingles = {" ".join(tokens[i : i + n]) for i in range(len(tokens) - n + 1)}
+        hashes = np.fromiter(
+            (_hash32(s.encode()) for s in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+        # Universal hashing (a * x + b) mod p, one permutation per column.
+        # Overflow wraps around, which is fine for hashing.
+        permuted = (np.outer(hashes, self._a) + self._b) % _MERSENNE_PRIME & _MAX_HASH
+        return permuted.min(axis=0)
+
+    def _check_banding(self):
+        """Rebuild the band keys from the stored signatures if they were
+        computed with a different split."""
+        banding = f"{self.bands}x{self.rows}"
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM info WHERE key = 'banding'"
+            ).fetchone()
+            if row is not None and row[0] == banding:
+                return
+            self._conn.execute("DELETE FROM band")
+            signatures = self._conn.execute(
+                "SELECT chunk_id, tenant, signature FROM signature"
+            ).fetchall()
+            self._conn.executemany(
+                "INSERT INTO band (tenant, band, key, chunk_id) VALUES (?, ?, ?, ?)",
+                (
+                    (tenant, band, key, chunk_id)
+                    for chunk_id, tenant, signature in signatures
+                    for band, key in enumerate(
+                        self.band_keys(np.frombuffer(signature, dtype=np.uint64))
+                    )
+                ),
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO info (key, value) VALUES ('banding', ?)",
+                (banding,),
+            )
+            self._conn.commit()
+
+    def band_keys(self, signature: np.ndarray) -> list[int]:
+        return [
+            int.from_bytes(
+                hashlib.blake2b(band.tobytes(), digest_size=8).digest(),
+                "little",
+                signed=True,
+            )
+            for band in signature[: self.bands * self.rows].reshape(
+                self.bands, self.rows
+            )
+        ]
+
+    def batch(self) -> DedupBatch:
+        return DedupBatch(self)
+
+    def candidates(
+        self, tenant: str, keys: Sequence[int]
+    ) -> list[tuple[str, str, int, np.ndarray]]:
+        """Stored chunks sharing at least one band with `keys`."""
+        values = ", ".join("(?, ?)" for _ in keys)
+        params: list = [tenant]
+        for band, key in enumerate(keys):
+            params += [band, key]
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT s.chunk_id, s.tenant, s.src_id, s.signature FROM signature s"
+                " WHERE s.chunk_id IN (SELECT chunk_id FROM band"
+                f" WHERE tenant = ? AND (band, key) IN (VALUES {values}))",
+                params,
+            ).fetchall()
+        return [
+            (chunk_id, tenant, src_id, np.frombuffer(signature, dtype=np.uint64))
+            for chunk_id, tenant, src_id, signature in rows
+        ]
+
+    def save(self, batch: DedupBatch):
+        """Persist the originals and duplicates of a batch once it's indexed."""
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO signature (chunk_id, tenant, src_id, signature)"
+                " VALUES (?, ?, ?, ?)",
+                [
+                    (chunk_id, tenant, src_id, signature.tobytes())
+                    for chunk_id, tenant, src_id, signature in batch.originals
+                ],
+            )
+            self._conn.executemany(
+                "DELETE FROM band WHERE chunk_id = ?",
+                [(o[0],) for o in batch.originals],
+            )
+            self._conn.executemany(
+                "INSERT INTO band (tenant, band, key, chunk_id) VALUES (?, ?, ?, ?)",
+                [
+                    (tenant, band, key, chunk_id)
+                    for chunk_id, tenant, _, signature in batch.originals
+                    for band, key in enumerate(self.band_keys(signature))
+                ],
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO duplicate (chunk_id, tenant, src_id,"
+                " original_id, original_src_id, similarity, text, metadata)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        chunk_id,
+                        tenant,
+                        src_id,
+                        original_id,
+                        original_src_id,
+                        similarity,
+                        doc.page_content,
+                        json.dumps(doc.metadata, default=str),
+                    )
+                    for (
+                        chunk_id,
+                        tenant,
+                        src_id,
+                        original_id,
+                        original_src_id,
+                        similarity,
+                        doc,
+                    ) in batch.duplicates
+                ],
+            )
+            self._conn.commit()
+
+    def signed(self, chunk_ids: Iterable[str]) -> set[str]:
+        """Which of `chunk_ids` are registered as originals."""
+        chunk_ids = list(chunk_ids)
+        found = set()
+        with self._lock:
+            for start in range(0, len(chunk_ids), 500):
+                page = chunk_ids[start : start + 500]
+                found.update(
+                    row[0]
+                    for row in self._conn.execute(
+                        "SELECT chunk_id FROM signature"
+                        f" WHERE chunk_id IN ({','.join('?' * len(page))})",
+                        page,
+                    )
+                )
+        return found
+
+    def duplicates(self, src_ids: Sequence[int]) -> dict[str, tuple[str, int, float]]:
+        """Map each chunk of `src_ids` collapsed as a duplicate to
+        (original id, original src_id, similarity)."""
+        if not src_ids:
+            return {}
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chunk_id, original_id, original_src_id, similarity"
+                " FROM duplicate"
+                f" WHERE src_id IN ({','.join('?' * len(src_ids))})",
+                list(src_ids),
+            ).fetchall()
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    def aliases(self, src_ids: Sequence[int]) -> dict[str, tuple[int, Document]]:
+        """Originals outside `src_ids` that stand in for duplicates inside them.
+
+        Maps each such original's chunk id to (its src_id, the duplicate's
+        Document), so a search restricted to `src_ids` can include the
+        original's source and report a hit on it as the duplicate.
+        """
+        if not src_ids:
+            return {}
+        marks = ",".join("?" * len(src_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chunk_id, original_id, original_src_id, text, metadata"
+                f" FROM duplicate WHERE src_id IN ({marks})"
+                f" AND original_src_id NOT IN ({marks})",
+                [*src_ids, *src_ids],
+            ).fetchall()
+        aliases = {}
+        for chunk_id, original_id, original_src_id, text, metadata in rows:
+            doc = Document(
+                page_content=text, metadata=json.loads(metadata), id=chunk_id
+            )
+            aliases.setdefault(original_id, (original_src_id, doc))
+        return aliases
+
+    def release(self, chunk_ids: Iterable[str]) -> list[Duplicate]:
+        """Forget deleted chunks, whether originals or duplicates.
+
+        Returns the duplicates that pointed at a deleted original, which are
+        no longer represented in the index and must be indexed again.
+        """
+        chunk_ids = list(chunk_ids)
+        orphans = []
+        with self._lock:
+            for start in range(0, len(chunk_ids), 500):
+                page = chunk_ids[start : start + 500]
+                marks = ",".join("?" * len(page))
+                for chunk_id, tenant, text, metadata in self._conn.execute(
+                    "SELECT chunk_id, tenant, text, metadata FROM duplicate"
+                    f" WHERE original_id IN ({marks}) AND chunk_id NOT IN ({marks})",
+                    [*page, *page],
+                ):
+                    doc = Document(
+                        page_content=text, metadata=json.loads(metadata), id=chunk_id
+                    )
+                    orphans.append(Duplicate(chunk_id, tenant, doc))
+                for table, column in (
+                    ("signature", "chunk_id"),
+                    ("band", "chunk_id"),
+                    ("duplicate", "chunk_id"),
+                    ("duplicate", "original_id"),
+                ):
+                    self._conn.execute(
+                        f"DELETE FROM {table} WHERE {column} IN ({marks})", page
+                    )
+            self._conn.commit()
+        return orphans
+
+    def stats(self) -> dict[str, int]:
+        """How many chunks are indexed, how many were collapsed, and their size."""
+        with self._lock:
+            (originals,) = self._conn.execute(
+                "SELECT COUNT(*) FROM signature"
+            ).fetchone()
+            duplicates, saved_chars = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(text)), 0) FROM duplicate"
+            ).fetchone()
+        return {
+            "originals": originals,
+            "duplicates": duplicates,
+            "saved_chars": saved_chars,
+        }
@@ -0,0 +1,168 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Sequence
+
+from langchain_core.embeddings import Embeddings
+
+import metrics
+
+# SQLite caps the number of bound parameters per statement
+_LOOKUP_CHUNK = 500
+
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class EmbeddingCache:
+    """Persistent embedding store keyed on (model, kind, sha256 of the text).
+
+    `kind` separates document and query embeddings, since providers such as
+    Gemini embed them with different task types. Entries are evicted least
+    recently used first once there are more than `max_entries`.
+    """
+
+    def __init__(self, path: str = "embedding_cache.sqlite", max_entries=500_000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embedding (
+                model TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, kind, text_hash)
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_embedding_last_used ON embedding (last_used)"
+        )
+        self._conn.commit()
+        # Kept up to date by put_many and _evict, so inserting never counts
+        # the whole table
+        (self._count,) = self._conn.execute("SELECT COUNT(*) FROM embedding").fetchone()
+
+    def get_many(
+        self, model: str, kind: str, hashes: Sequence[str]
+    ) -> dict[str, list[float]]:
+        """Return the cached vectors for whichever of `hashes` are present."""
+        found: dict[str, list[float]] = {}
+        unique = list(dict.fromkeys(hashes))
+        with self._lock:
+            for i in range(0, len(unique), _LOOKUP_CHUNK):
+                chunk = unique[i : i + _LOOKUP_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embedding WHERE model = ? AND kind = ?"
+                    f" AND text_hash IN ({placeholders})",
+                    [model, kind, *chunk],
+                )
+                for text_hash, blob in rows:
+                    found[text_hash] = array("f", blob).tolist()
+
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embedding SET last_used = ? WHERE model = ? AND kind = ?"
+                    " AND text_hash = ?",
+                    [(now, model, kind, h) for h in found],
+                )
+                self._conn.commit()
+
+            self.hits += sum(1 for h in hashes if h in found)
+            self.misses += sum(1 for h in hashes if h not in found)
+        return found
+
+    def put_many(self, model: str, kind: str, vectors: dict[str, list[float]]):
+        now = time.time()
+        hashes = list(vectors)
+        with self._lock:
+            # Replaced entries don't add to the count
+            existing = 0
+            for i in range(0, len(hashes), _LOOKUP_CHUNK):
+                chunk = hashes[i : i + _LOOKUP_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                (found,) = self._conn.execute(
+                    f"SELECT COUNT(*) FROM embedding WHERE model = ? AND kind = ?"
+                    f" AND text_hash IN ({placeholders})",
+                    [model, kind, *chunk],
+                ).fetchone()
+                existing += found
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embedding VALUES (?, ?, ?, ?, ?)",
+                [
+                    (model, kind, h, array("f", v).tobytes(), now)
+                    for h, v in vectors.items()
+                ],
+            )
+            self._count += len(hashes) - existing
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        if self._count <= self.max_entries:
+            return
+        # Trim a little below the cap so we don't evict on every insert
+        excess = self._count - int(self.max_entries * 0.9)
+        self._count -= self._conn.execute(
+            "DELETE FROM embedding WHERE rowid IN"
+            " (SELECT rowid FROM embedding ORDER BY last_used LIMIT ?)",
+            (excess,),
+        ).rowcount
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            (entries,) = self._conn.execute("SELECT COUNT(*) FROM embedding").fetchone()
+            return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that only calls the wrapped model on cache misses.
+
+    Drop-in replacement for any LangChain `Embeddings`, so Chroma and
+    similarity search both go through the cache without knowing about it.
+    """
+
+    def __init__(self, embeddings: Embeddings, model_name: str, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.cache = cache
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        hashes = [_text_hash(t) for t in texts]
+        found = self.cache.get_many(self.model_name, "document", hashes)
+
+        # Embed each distinct missing text once, even if it repeats in the batch
+        missing = {h: t for h, t in zip(hashes, texts) if h not in found}
+        if missing:
+            with metrics.span(
+                "embedding.documents", model=self.model_name, texts=len(missing)
+            ):
+                vectors = self.embeddings.embed_documents(list(missing.values()))
+            new = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(self.model_name, "document", new)
+            found.update(new)
+
+        return [found[h] for h in hashes]
+
+    def embed_query(self, text: str) -> list[float]:
+        h = _text_hash(text)
+        found = self.cache.get_many(self.model_name, "query", [h])
+        if h in found:
+            return found[h]
+
+        with metrics.span("embedding.query", model=self.model_name):
+            vector = self.embeddings.embed_query(text)
+        self.cache.put_many(self.model_name, "query", {h: vector})
+        return vector
@@ -0,0 +1,141 @@
+"""Embed-and-upsert stage of the ingestion pipeline.
+
+Chunks are written in batches, several batches in flight at once, behind a
+token-bucket rate limiter so large uploads stay under the embedding API quota.
+Failed batches are retried with exponential backoff. Chunks are stored under
+their own `Document.id`, which the caller derives from the chunk's source and
+text, so a retried or resumed batch overwrites rather than duplicates.
+"""
+
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from itertools import islice
+from typing import Iterable, Iterator
+
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+import metrics
+from lexical_index import LexicalIndex
+from vector_shards import ShardedChroma
+
+
+def batched(items: Iterable, n: int) -> Iterator[list]:
+    """Yield lists of up to `n` items, pulling lazily from `items`."""
+    it = iter(items)
+    while batch := list(islice(it, n)):
+        yield batch
+
+
+class TokenBucket:
+    """Thread-safe token bucket. `acquire` blocks until enough tokens exist."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n: float = 1.0):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._last) * self.rate
+                )
+                self._last = now
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return
+                wait_for = (n - self._tokens) / self.rate
+            time.sleep(wait_for)
+
+
+class EmbeddingWriter:
+    def __init__(
+        self,
+        vector_store: VectorStore | ShardedChroma,
+        lexical_index: LexicalIndex,
+        batch_size: int = 64,
+        max_in_flight: int = 4,
+        requests_per_minute: float = 600,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+    ):
+        self.vector_store = vector_store
+        self.lexical_index = lexical_index
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.rate_limiter = TokenBucket(
+            rate=requests_per_minute / 60, capacity=max(1, max_in_flight)
+        )
+
+    def write(self, docs: Iterable[Document], status=None) -> int:
+        """Embed and store `docs`, returning how many chunks were written.
+
+        Args:
+            docs: Normalized chunks with their ids set.
+            status: Object with an `update(label=...)` method for progress,
+                or None.
+        """
+        written = 0
+        error: BaseException | None = None
+
+        def finish(done: set[Future]):
+            nonlocal written, error
+            for future in done:
+                try:
+                    batch = future.result()
+                except BaseException as e:
+                    error = error or e
+                    continue
+                written += len(batch)
+            if status is not None:
+                status.update(label=f"Embedded {written} chunks")
+
+        with ThreadPoolExecutor(
+            max_workers=self.max_in_flight, thread_name_prefix="embedding-writer"
+        ) as pool:
+            in_flight: set[Future] = set()
+            for batch in batched(docs, self.batch_size):
+                if len(in_flight) >= self.max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    finish(done)
+                if error:
+                    break
+                in_flight.add(pool.submit(self._write_batch, batch))
+            finish(wait(in_flight).done)
+
+        if error:
+            raise error
+        return written
+
+    def _write_batch(self, batch: list[Document]) -> list[Document]:
+        ids = [d.id for d in batch]
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            delay = self.backoff * 2**attempt * random.uniform(0.5, 1.0)
+            try:
+                with metrics.span(
+                    "chroma.add", chunks=len(batch), attempt=attempt
+                ) as attrs:
+                    try:
+                        self.vector_store.add_documents(batch, ids=ids)
+                    except Exception as e:
+                        attrs["error"] = repr(e)
+                        if attempt < self.max_retries:
+                            attrs["retry_in"] = round(delay, 1)
+                        raise
+                break
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(delay)
+
+        self.lexical_index.upsert(ids, batch)
+        return batch
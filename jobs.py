@@ -0,0 +1,282 @@
+"""Background ingestion queue backed by the `ingest_job` table.
+
+Uploads are saved to the blob store straight away and a job row is written for
+the slow part (parsing, cleanup and embedding). A small pool of worker threads
+claims pending rows and runs them, so the chat page only has to poll the table
+for progress. Jobs left RUNNING by a crash are picked up again on startup, and
+failures are retried with exponential backoff up to `max_attempts`.
+"""
+
+import json
+import threading
+import time
+import traceback
+from typing import IO, Sequence
+
+from sqlalchemy import select, update
+
+import database
+import metrics
+from database import Chat, FileItem, IngestJob, JobState
+from vector_store import VectorStoreHelper
+
+
+class JobProgress:
+    """Status sink for VectorStoreHelper that records progress on the job row.
+
+    Progress is written on its own connection so it is visible to pollers
+    immediately, without committing the worker's session.
+    """
+
+    def __init__(self, job_id: int):
+        self.job_id = job_id
+
+    def update(self, label: str | None = None, **kwargs):
+        if label is None:
+            return
+        with database.engine.begin() as conn:
+            conn.execute(
+                update(IngestJob)
+                .where(IngestJob.id == self.job_id)
+                .values(progress=label[:1024], updated_at=time.time())
+            )
+
+
+class JobQueue:
+    def __init__(
+        self,
+        vector_store: VectorStoreHelper,
+        workers: int = 2,
+        poll_interval: float = 2.0,
+        max_attempts: int = 3,
+        retry_delay: float = 5.0,
+    ):
+        self.vector_store = vector_store
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+        self._wake = threading.Event()
+        self._threads: list[threading.Thread] = []
+
+    def start(self):
+        """Requeue jobs interrupted by a restart and start the workers."""
+        db_session = database.db_session
+        db_session.execute(
+            update(IngestJob)
+            .where(IngestJob.state == JobState.RUNNING)
+            .values(state=JobState.PENDING, progress="Waiting to resume")
+        )
+        db_session.commit()
+        self._enqueue_backfill()
+        db_session.remove()
+
+        for n in range(self.workers):
+            thread = threading.Thread(
+                target=self._worker, name=f"ingest-worker-{n}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def enqueue_files(self, chat: Chat, files: Sequence[IO[bytes]]) -> IngestJob:
+        """Store the uploads now and index them in the background.
+
+        The new sources are enabled on `chat` right away, since the FileItems
+        exist as soon as this returns. An upload named like a source the chat
+        already has replaces it; otherwise a new source is created.
+        """
+        with database.unit_of_work():
+            source_items = self.vector_store.store_files(
+                files, replaceable=chat.enabled_source_ids
+            )
+            chat.add_enabled_sources(source_items)
+            job = self._enqueue("files", [i.id for i in source_items], chat.id)
+        self._wake.set()
+        return job
+
+    def enqueue_urls(self, chat: Chat, urls: list[str]) -> list[IngestJob]:
+        """Queue one job per URL. Each source is enabled on `chat` once indexed."""
+        with database.unit_of_work():
+            jobs = [self._enqueue("urls", [url], chat.id) for url in urls]
+        # Only wake the workers once the jobs are committed and claimable
+        self._wake.set()
+        return jobs
+
+    def _enqueue_backfill(self):
+        """Queue a backfill of the vector backend if it may be missing sources.
+
+        The backend of the latest backfill job is the one last active, and
+        that job completing means it was filled. A backfill is queued
+        whenever the configured backend differs from it, since sources
+        ingested while another backend was active are missing from this
+        one. One left running by a crash is requeued by `start` and resumes,
+        and a failed one is tried again on the next start.
+        """
+        db_session = database.db_session
+        backend = self.vector_store.vector_backend
+        latest = db_session.scalars(
+            select(IngestJob)
+            .where(IngestJob.kind == "backfill")
+            .order_by(IngestJob.id.desc())
+            .limit(1)
+        ).first()
+        if (
+            latest is None
+            or json.loads(latest.payload) != [backend]
+            or latest.state == JobState.FAILED
+        ):
+            self._enqueue("backfill", [backend], None)
+
+    def _enqueue(self, kind: str, payload: list, chat_id: int | None) -> IngestJob:
+        db_session = database.db_session
+        job = IngestJob(
+            kind=kind,
+            payload=json.dumps(payload),
+            chat_id=chat_id,
+            max_attempts=self.max_attempts,
+            progress="Queued",
+        )
+        db_session.add(job)
+        database.commit()
+        return job
+
+    def _worker(self):
+        while True:
+            job = self._claim()
+            if job is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            self._run(job)
+
+    def _claim(self) -> IngestJob | None:
+        """Atomically move the oldest runnable job from PENDING to RUNNING."""
+        db_session = database.db_session
+        try:
+            while True:
+                job_id = db_session.scalar(
+                    select(IngestJob.id)
+                    .where(
+                        IngestJob.state == JobState.PENDING,
+                        IngestJob.run_after <= time.time(),
+                    )
+                    .order_by(IngestJob.id)
+                    .limit(1)
+                )
+                if job_id is None:
+                    db_session.commit()
+                    return None
+
+                claimed = db_session.execute(
+                    update(IngestJob)
+                    .where(IngestJob.id == job_id, IngestJob.state == JobState.PENDING)
+                    .values(
+                        state=JobState.RUNNING,
+                        attempts=IngestJob.attempts + 1,
+                        progress="Starting",
+                    )
+                ).rowcount
+                db_session.commit()
+                if claimed:
+                    return db_session.get(IngestJob, job_id, populate_existing=True)
+        except Exception:
+            db_session.rollback()
+            traceback.print_exc()
+            return None
+
+    def _run(self, job: IngestJob):
+        db_session = database.db_session
+        payload = json.loads(job.payload)
+        progress = JobProgress(job.id)
+        # Sources created by a failed attempt are removed so a retry starts clean
+        created: list[int] = []
+
+        try:
+            with metrics.span("job.run", job_id=job.id, kind=job.kind):
+                if job.kind == "files":
+                    source_items = list(
+                        db_session.scalars(
+                            select(FileItem).where(FileItem.id.in_(payload))
+                        )
+                    )
+                    self.vector_store.index_files(source_items, progress)
+                elif job.kind == "urls":
+                    source_items = self.vector_store.add_urls(
+                        payload, progress, created
+                    )
+                    if not source_items:
+                        raise RuntimeError(f"Could not add {', '.join(payload)}")
+                    if job.chat_id is not None and (
+                        chat := db_session.get(Chat, job.chat_id)
+                    ):
+                        chat.add_enabled_sources(source_items)
+                elif job.kind == "backfill":
+                    self.vector_store.backfill_vectors(progress)
+                else:
+                    raise ValueError(f"Unknown job kind {job.kind!r}")
+        except Exception as e:
+            db_session.rollback()
+            traceback.print_exc()
+            if created:
+                partial = db_session.scalars(
+                    select(FileItem).where(FileItem.id.in_(created))
+                ).all()
+                for item in partial:
+                    self.vector_store.delete_source(item)
+            self._finish_failed(job, e)
+        else:
+            job.state = JobState.DONE
+            job.progress = "Done"
+            job.error = None
+            db_session.merge(job)
+            db_session.commit()
+        finally:
+            db_session.remove()
+
+    def _finish_failed(self, job: IngestJob, error: Exception):
+        db_session = database.db_session
+        job = db_session.get(IngestJob, job.id, populate_existing=True)
+        job.error = f"{type(error).__name__}: {error}"
+        if job.attempts < job.max_attempts:
+            delay = self.retry_delay * 2 ** (job.attempts - 1)
+            job.state = JobState.PENDING
+            job.run_after = time.time() + delay
+            job.progress = f"Retrying in {delay:.0f}s"
+        else:
+            job.state = JobState.FAILED
+            job.progress = "Failed"
+        db_session.commit()
+
+
+def describe_job(job: IngestJob) -> str:
+    payload = json.loads(job.payload)
+    if job.kind == "urls":
+        return ", ".join(payload)
+    if job.kind == "backfill":
+        return f"the {payload[0]} vector index"
+    return f"{len(payload)} file(s)"
+
+
+def active_jobs(chat_id: int) -> list[IngestJob]:
+    """Jobs for a chat that are still queued, running, or failed for good."""
+    return list(
+        database.db_session.scalars(
+            select(IngestJob)
+            .where(
+                IngestJob.chat_id == chat_id,
+                IngestJob.state.in_(
+                    [JobState.PENDING, JobState.RUNNING, JobState.FAILED]
+                ),
+            )
+            .order_by(IngestJob.id)
+        )
+    )
+
+
+def dismiss_job(job: IngestJob):
+    """Hide a finished or failed job from its chat's status list."""
+    database.db_session.execute(
+        update(IngestJob).where(IngestJob.id == job.id).values(chat_id=None)
+    )
+    database.db_session.commit()
@@ -0,0 +1,199 @@
+import json
+import re
+import sqlite3
+import threading
+from typing import Iterable, Iterator, Sequence
+
+from langchain_core.documents import Document
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def _match_query(query: str) -> str | None:
+    """Turn free text into an FTS5 query that ORs every term together.
+
+    Terms are quoted so user input can never be parsed as FTS5 syntax.
+    """
+    terms = dict.fromkeys(t.lower() for t in _TOKEN.findall(query))
+    if not terms:
+        return None
+    return " OR ".join(f'"{t}"' for t in terms)
+
+
+class LexicalIndex:
+    """Local BM25 index over the same chunks stored in the vector store.
+
+    Backed by an SQLite FTS5 table, so it is persistent, updated one batch at
+    a time, and answers keyword queries without any API call.
+    """
+
+    def __init__(self, path: str = "lexical_index.sqlite"):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS chunk USING fts5(
+                text,
+                chunk_id UNINDEXED,
+                src_id UNINDEXED,
+                metadata UNINDEXED,
+                tokenize = 'unicode61'
+            )
+            """
+        )
+        # FTS5 can't index its UNINDEXED columns, so filtering `chunk` by id
+        # or source scans the whole table. This maps both to the chunk's rowid.
+        has_keys = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'chunk_key'"
+        ).fetchone()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunk_key"
+            " (rowid INTEGER PRIMARY KEY, chunk_id TEXT, src_id INTEGER)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS chunk_key_chunk_id ON chunk_key (chunk_id)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS chunk_key_src_id ON chunk_key (src_id)"
+        )
+        if not has_keys:
+            self._conn.execute(
+                "INSERT INTO chunk_key (rowid, chunk_id, src_id)"
+                " SELECT rowid, chunk_id, src_id FROM chunk"
+            )
+        self._conn.commit()
+
+    def add(self, ids: Sequence[str], docs: Sequence[Document]):
+        with self._lock:
+            self._insert(ids, docs)
+            self._conn.commit()
+
+    def upsert(self, ids: Sequence[str], docs: Sequence[Document]):
+        """Replace any existing rows for `ids`, so retried writes don't duplicate."""
+        with self._lock:
+            self._delete_where("chunk_id", ids)
+            self._insert(ids, docs)
+            self._conn.commit()
+
+    def _insert(self, ids: Sequence[str], docs: Sequence[Document]):
+        rows = []
+        for chunk_id, doc in zip(ids, docs):
+            src_id = doc.metadata.get("src_id")
+            rowid = self._conn.execute(
+                "INSERT INTO chunk_key (chunk_id, src_id) VALUES (?, ?)",
+                (chunk_id, src_id),
+            ).lastrowid
+            rows.append(
+                (
+                    rowid,
+                    doc.page_content,
+                    chunk_id,
+                    src_id,
+                    json.dumps(doc.metadata, default=str),
+                )
+            )
+        self._conn.executemany(
+            "INSERT INTO chunk (rowid, text, chunk_id, src_id, metadata)"
+            " VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+
+    def _delete_where(self, column: str, values: Iterable):
+        """Delete the chunks whose `column` in chunk_key is any of `values`."""
+        rowids = [
+            (rowid,)
+            for value in values
+            for (rowid,) in self._conn.execute(
+                f"SELECT rowid FROM chunk_key WHERE {column} = ?", (value,)
+            )
+        ]
+        self._conn.executemany("DELETE FROM chunk WHERE rowid = ?", rowids)
+        self._conn.executemany("DELETE FROM chunk_key WHERE rowid = ?", rowids)
+
+    def delete(self, ids: Iterable[str]):
+        with self._lock:
+            self._delete_where("chunk_id", ids)
+            self._conn.commit()
+
+    def delete_sources(self, src_ids: Iterable[int]):
+        with self._lock:
+            self._delete_where("src_id", src_ids)
+            self._conn.commit()
+
+    def pages(self, page_size: int = 1000) -> Iterator[list[Document]]:
+        """Every indexed chunk, with its id set, a page at a time."""
+        last = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT rowid, chunk_id, text, metadata FROM chunk"
+                    " WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                    (last, page_size),
+                ).fetchall()
+            if not rows:
+                break
+            last = rows[-1][0]
+            yield [
+                Document(page_content=text, metadata=json.loads(metadata), id=chunk_id)
+                for _, chunk_id, text, metadata in rows
+            ]
+
+    def source_ids(self) -> list[int]:
+        """Every source with indexed chunks."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT src_id FROM chunk_key WHERE src_id IS NOT NULL"
+            ).fetchall()
+        return sorted(r[0] for r in rows)
+
+    def documents(self, src_id: int) -> list[Document]:
+        """The indexed chunks of one source, with their ids set."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chunk_id, text, metadata FROM chunk WHERE rowid IN"
+                " (SELECT rowid FROM chunk_key WHERE src_id = ?)",
+                (src_id,),
+            ).fetchall()
+        return [
+            Document(page_content=text, metadata=json.loads(metadata), id=chunk_id)
+            for chunk_id, text, metadata in rows
+        ]
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM chunk LIMIT 1").fetchone() is None
+
+    def search(
+        self, query: str, k: int = 4, src_ids: Sequence[int] | None = None
+    ) -> list[tuple[str, Document, float]]:
+        """Return up to `k` (chunk id, Document, BM25 score) triples, best first.
+
+        Higher scores are better. `src_ids` restricts the search to chunks
+        from those sources; None searches everything.
+        """
+        match = _match_query(query)
+        if match is None or (src_ids is not None and not src_ids):
+            return []
+
+        sql = (
+            "SELECT chunk_id, text, metadata, -bm25(chunk) AS score FROM chunk"
+            " WHERE chunk MATCH ?"
+        )
+        params: list = [match]
+        if src_ids is not None:
+            sql += f" AND src_id IN ({','.join('?' * len(src_ids))})"
+            params += list(src_ids)
+        sql += " ORDER BY bm25(chunk) LIMIT ?"
+        params.append(k)
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [
+            (
+                chunk_id,
+                Document(page_content=text, metadata=json.loads(metadata)),
+                score,
+            )
+            for chunk_id, text, metadata, score in rows
+        ]
@@ -0,0 +1,217 @@
+"""Latency spans, exported as JSON log lines and Prometheus histograms.
+
+Wrap a stage in `span("name")` to time it. Every finished span is logged as
+one JSON object on the `metrics` logger and observed in a histogram labelled
+with the span name and whether it raised. Spans opened inside another span
+share its trace id and record it as their parent, so the log lines of one
+chat request or ingestion job can be grouped back together.
+
+`write_prometheus` renders every histogram in the Prometheus text format,
+and `start_exporter` rewrites that file periodically so it can be scraped
+with node_exporter's textfile collector or just read by hand.
+"""
+
+import bisect
+import contextvars
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Iterable, Iterator, TypeVar
+
+from sqlalchemy import Engine, event
+
+T = TypeVar("T")
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Database queries are only logged individually when slower than this. The
+# histogram still sees every one.
+SLOW_QUERY_SECONDS = 0.1
+
+logger = logging.getLogger("metrics")
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# (trace id, span id) of the innermost open span in this context
+_current: contextvars.ContextVar[tuple[str, str] | None] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram, in seconds."""
+
+    def __init__(self, buckets: Iterable[float] = BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+_lock = threading.Lock()
+_histograms: dict[tuple[str, str], Histogram] = {}
+
+
+def observe(name: str, seconds: float, status: str = "ok", log: bool = True, **attrs):
+    """Record a duration measured elsewhere, as if it were a span."""
+    with _lock:
+        histogram = _histograms.get((name, status))
+        if histogram is None:
+            histogram = _histograms[(name, status)] = Histogram()
+        histogram.observe(seconds)
+    if not log:
+        return
+
+    parent = _current.get()
+    record = {
+        "span": name,
+        "trace_id": parent[0] if parent else None,
+        "parent_id": parent[1] if parent else None,
+        "duration_ms": round(seconds * 1000, 3),
+        "status": status,
+    }
+    record.update(attrs)
+    logger.info(json.dumps(record, default=str))
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[dict]:
+    """Time the enclosed block as a span called `name`.
+
+    Yields a dict of attributes that the block can add to before the span is
+    logged, such as result counts.
+    """
+    parent = _current.get()
+    trace_id = parent[0] if parent else uuid.uuid4().hex
+    span_id = uuid.uuid4().hex[:16]
+    token = _current.set((trace_id, span_id))
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield attrs
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        _current.reset(token)
+        observe(
+            name,
+            duration,
+            status=status,
+            trace_id=trace_id,
+            parent_id=parent[1] if parent else None,
+            span_id=span_id,
+            **attrs,
+        )
+
+
+def timed_iter(name: str, items: Iterable[T], **attrs) -> Iterator[T]:
+    """Pass `items` through, timing only the work done producing them.
+
+    Generator stages are interleaved with their consumers, so this adds up
+    the time spent inside each `next` and records it as one span at the end.
+    """
+    it = iter(items)
+    busy = 0.0
+    count = 0
+    status = "ok"
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                busy += time.perf_counter() - start
+                break
+            busy += time.perf_counter() - start
+            count += 1
+            yield item
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        observe(name, busy, status=status, items=count, **attrs)
+
+
+def render_prometheus() -> str:
+    """Every histogram in the Prometheus text exposition format."""
+    with _lock:
+        snapshot = {
+            key: (list(h.counts), h.sum, h.count, h.buckets)
+            for key, h in sorted(_histograms.items())
+        }
+
+    lines = [
+        "# HELP app_span_duration_seconds Time spent in each instrumented stage.",
+        "# TYPE app_span_duration_seconds histogram",
+    ]
+    for (name, status), (counts, total, count, buckets) in snapshot.items():
+        labels = f'span="{name}",status="{status}"'
+        cumulative = 0
+        for bound, n in zip(buckets, counts):
+            cumulative += n
+            lines.append(
+                f'app_span_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}'
+            )
+        lines.append(f'app_span_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+        lines.append(f"app_span_duration_seconds_sum{{{labels}}} {total}")
+        lines.append(f"app_span_duration_seconds_count{{{labels}}} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path: str = "metrics.prom"):
+    """Atomically replace `path` with the current metrics."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metrics-")
+    with os.fdopen(fd, "w") as f:
+        f.write(render_prometheus())
+    os.replace(tmp_path, path)
+
+
+def start_exporter(path: str = "metrics.prom", interval: float = 15.0):
+    """Rewrite the metrics file every `interval` seconds on a daemon thread."""
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                write_prometheus(path)
+            except OSError as e:
+                logger.warning(json.dumps({"error": f"metrics export failed: {e}"}))
+
+    thread = threading.Thread(target=run, name="metrics-exporter", daemon=True)
+    thread.start()
+    return thread
+
+
+def instrument_engine(engine: Engine):
+    """Observe a `db.query` span for every statement run through `engine`."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        context.metrics_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - context.metrics_start
+        observe(
+            "db.query",
+            duration,
+            log=duration >= SLOW_QUERY_SECONDS,
+            statement=statement.split(None, 1)[0].upper(),
+        )
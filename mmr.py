@@ -0,0 +1,78 @@
+"""Diverse selection of retrieved chunks with maximal marginal relevance.
+
+Nearest neighbours are often overlapping chunks of the same page, which
+spend the context window repeating themselves. MMR picks chunks one at a
+time, trading relevance to the query against similarity to what has already
+been picked, using the candidates' stored vectors so nothing is re-embedded.
+"""
+
+from typing import Hashable, Sequence
+
+import numpy as np
+
+
+def mmr_select(
+    query_vector: Sequence[float],
+    vectors: np.ndarray,
+    sources: Sequence[Hashable],
+    tokens: Sequence[int],
+    k: int,
+    lambda_mult: float = 0.5,
+    per_source_cap: int | None = None,
+    token_budget: int | None = None,
+) -> list[int]:
+    """Indices of up to `k` candidates, in the order they were picked.
+
+    Each pick maximizes `lambda_mult * sim(query, c) - (1 - lambda_mult) *
+    max(sim(c, picked))`. Candidates from a source that already has
+    `per_source_cap` picks, or longer than the tokens left in
+    `token_budget`, are skipped. The first pick ignores the budget so there
+    is always some context.
+
+    Args:
+        query_vector: Embedding of the query.
+        vectors: Candidate embeddings, one per row.
+        sources: Source of each candidate, for the per-source cap.
+        tokens: Estimated token count of each candidate.
+    """
+    if not len(vectors):
+        return []
+    # Copies, as they are normalized in place
+    candidates = np.array(vectors, dtype=np.float32, copy=True)
+    candidates /= np.linalg.norm(candidates, axis=1, keepdims=True).clip(1e-12)
+    query = np.array(query_vector, dtype=np.float32, copy=True)
+    query /= max(float(np.linalg.norm(query)), 1e-12)
+
+    relevance = candidates @ query
+    # Every pairwise similarity at once; candidate lists are small
+    similarity = candidates @ candidates.T
+    redundancy = np.full(len(candidates), -np.inf, dtype=np.float32)
+    available = np.ones(len(candidates), dtype=bool)
+    tokens = np.asarray(tokens)
+    # Sources as integer labels, so capping a source is one vector comparison
+    label_of: dict[Hashable, int] = {}
+    labels = np.array([label_of.setdefault(s, len(label_of)) for s in sources])
+    per_source = np.zeros(len(label_of), dtype=np.int64)
+    remaining = token_budget
+
+    picked: list[int] = []
+    while len(picked) < k:
+        if picked and remaining is not None:
+            available &= tokens <= remaining
+        if not available.any():
+            break
+        penalty = np.where(np.isinf(redundancy), 0.0, redundancy)
+        scores = lambda_mult * relevance - (1 - lambda_mult) * penalty
+        pick = int(np.argmax(np.where(available, scores, -np.inf)))
+
+        picked.append(pick)
+        available[pick] = False
+        redundancy = np.maximum(redundancy, similarity[pick])
+        if remaining is not None:
+            remaining -= int(tokens[pick])
+        if per_source_cap is not None:
+            label = labels[pick]
+            per_source[label] += 1
+            if per_source[label] >= per_source_cap:
+                available &= labels != label
+    return picked
@@ -0,0 +1,408 @@
+"""Compact on-disk vector index: int8 vectors in memory-mapped arrays.
+
+An alternative to Chroma for large corpora. Each tenant's partition is a
+directory of flat arrays, one row per chunk:
+
+    vectors.i8    unit-length embeddings quantized to int8, one scale per row
+    scales.f32    the scale of each row
+    src_ids.i32   the source of each row, TOMBSTONE once the row is deleted
+    vectors.f32   the unquantized embeddings, only read to re-score top hits
+
+plus `chunks.sqlite`, which maps rows to chunk ids, text and metadata and is
+only read for the hits that are returned.
+
+Search scans the int8 rows of the wanted sources in blocks with NumPy, so
+the working set is a quarter of float32 and the arrays are paged in by the
+OS as they are read. Opening a partition only maps the files, so cold start
+doesn't depend on corpus size. Rows are appended; deleted rows are
+tombstoned and dropped by `compact` once they make up a large part of the
+partition.
+"""
+
+import json
+import math
+import os
+import sqlite3
+import threading
+from typing import Iterator, Sequence
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+import database
+from vector_shards import ShardedVectorStore
+
+TOMBSTONE = np.iinfo(np.int32).min
+
+# Rows scored per NumPy operation, which bounds the float32 scratch space
+BLOCK_ROWS = 8192
+
+
+def _quantize(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Symmetric per-row int8 quantization: vectors ~= codes * scales[:, None]."""
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1.0
+    codes = np.rint(vectors / scales[:, None]).clip(-127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def _unit(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+def _relevance(cosine: float) -> float:
+    """Map cosine similarity to [0, 1] the way Chroma scores unit L2 distance."""
+    return 1.0 - math.sqrt(max(0.0, 2.0 - 2.0 * cosine)) / math.sqrt(2)
+
+
+class QuantizedPartition:
+    """One tenant's directory of memory-mapped arrays and chunk table."""
+
+    def __init__(
+        self,
+        path: str,
+        embeddings: Embeddings,
+        rescore: bool = True,
+        rescore_factor: int = 4,
+        compact_ratio: float = 0.3,
+    ):
+        self.path = path
+        self.embeddings = embeddings
+        self.rescore_factor = rescore_factor
+        self.compact_ratio = compact_ratio
+        os.makedirs(path, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(
+            os.path.join(path, "chunks.sqlite"), check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS chunk (
+                row INTEGER PRIMARY KEY,
+                chunk_id TEXT NOT NULL UNIQUE,
+                src_id INTEGER,
+                text TEXT NOT NULL,
+                metadata TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_chunk_src ON chunk (src_id);
+            CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT);
+            """
+        )
+        self._conn.commit()
+        row = self._conn.execute("SELECT value FROM info WHERE key = 'dim'").fetchone()
+        self.dim: int | None = int(row[0]) if row else None
+        # Partitions created without full-precision vectors can't re-score
+        self.rescore = rescore and (
+            self.dim is None or os.path.exists(self._file("vectors.f32"))
+        )
+        self._maps: tuple | None = None
+        self._recover()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _rows_on_disk(self) -> int:
+        sizes = [
+            os.path.getsize(self._file(name)) // width
+            if os.path.exists(self._file(name))
+            else 0
+            for name, width in self._layout()
+        ]
+        return min(sizes, default=0)
+
+    def _recover(self):
+        """Drop rows left half-written by an interrupted append."""
+        rows = self._rows_on_disk()
+        (committed,) = self._conn.execute(
+            "SELECT COALESCE(MAX(row) + 1, 0) FROM chunk"
+        ).fetchone()
+        if committed > rows:
+            self._conn.execute("DELETE FROM chunk WHERE row >= ?", (rows,))
+            self._conn.commit()
+        for name, width in self._layout():
+            if os.path.exists(self._file(name)):
+                os.truncate(self._file(name), min(rows, committed) * width)
+
+    def _layout(self) -> list[tuple[str, int]]:
+        if self.dim is None:
+            return []
+        layout = [("vectors.i8", self.dim), ("scales.f32", 4), ("src_ids.i32", 4)]
+        if self.rescore:
+            layout.append(("vectors.f32", self.dim * 4))
+        return layout
+
+    def _arrays(self):
+        """(codes, scales, src_ids, full) mapped over every row, or None if empty."""
+        if self._maps is None:
+            rows = self._rows_on_disk()
+            if not rows:
+                return None
+            self._maps = (
+                np.memmap(
+                    self._file("vectors.i8"), np.int8, "r", shape=(rows, self.dim)
+                ),
+                np.memmap(self._file("scales.f32"), np.float32, "r", shape=(rows,)),
+                np.memmap(self._file("src_ids.i32"), np.int32, "r", shape=(rows,)),
+                np.memmap(
+                    self._file("vectors.f32"), np.float32, "r", shape=(rows, self.dim)
+                )
+                if self.rescore
+                else None,
+            )
+        return self._maps
+
+    def add_documents(self, documents: Sequence[Document], ids: Sequence[str]):
+        vectors = _unit(
+            np.asarray(
+                self.embeddings.embed_documents([d.page_content for d in documents]),
+                dtype=np.float32,
+            )
+        )
+        codes, scales = _quantize(vectors)
+        src_ids = np.array(
+            [d.metadata.get("src_id", -1) for d in documents], dtype=np.int32
+        )
+
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._conn.execute(
+                    "INSERT INTO info (key, value) VALUES ('dim', ?)", (self.dim,)
+                )
+            # Re-adding a chunk replaces it, so a retried batch can't duplicate
+            self._tombstone(ids)
+            start = self._rows_on_disk()
+            arrays = {
+                "vectors.i8": codes,
+                "scales.f32": scales,
+                "src_ids.i32": src_ids,
+                "vectors.f32": vectors,
+            }
+            for name, _ in self._layout():
+                with open(self._file(name), "ab") as f:
+                    f.write(arrays[name].tobytes())
+            self._conn.executemany(
+                "INSERT INTO chunk (row, chunk_id, src_id, text, metadata)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        start + n,
+                        chunk_id,
+                        doc.metadata.get("src_id"),
+                        doc.page_content,
+                        json.dumps(doc.metadata, default=str),
+                    )
+                    for n, (chunk_id, doc) in enumerate(zip(ids, documents))
+                ],
+            )
+            self._conn.commit()
+            self._maps = None
+
+    def update_metadata(self, ids: Sequence[str], metadatas: Sequence[dict]):
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE chunk SET metadata = ? WHERE chunk_id = ?",
+                [
+                    (json.dumps(metadata, default=str), chunk_id)
+                    for chunk_id, metadata in zip(ids, metadatas)
+                ],
+            )
+            self._conn.commit()
+
+    def get(self, src_ids: Sequence[int], include: list[str]) -> dict[str, list]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chunk_id, text, metadata FROM chunk"
+                f" WHERE src_id IN ({','.join('?' * len(src_ids))}) ORDER BY row",
+                list(src_ids),
+            ).fetchall()
+        return self._page(rows, include)
+
+    @staticmethod
+    def _page(rows: list[tuple], include: Sequence[str]) -> dict[str, list]:
+        page = {"ids": [r[0] for r in rows]}
+        if "documents" in include:
+            page["documents"] = [r[1] for r in rows]
+        if "metadatas" in include:
+            page["metadatas"] = [json.loads(r[2]) for r in rows]
+        return page
+
+    def delete(self, ids: Sequence[str]):
+        with self._lock:
+            self._tombstone(ids)
+            self._conn.commit()
+            self._maybe_compact()
+
+    def _tombstone(self, ids: Sequence[str]):
+        rows = []
+        for start in range(0, len(ids), 500):
+            page = list(ids[start : start + 500])
+            rows += [
+                r[0]
+                for r in self._conn.execute(
+                    f"SELECT row FROM chunk WHERE chunk_id IN ({','.join('?' * len(page))})",
+                    page,
+                )
+            ]
+        if not rows:
+            return
+        src_ids = np.memmap(self._file("src_ids.i32"), np.int32, "r+")
+        src_ids[rows] = TOMBSTONE
+        src_ids.flush()
+        del src_ids
+        self._conn.executemany("DELETE FROM chunk WHERE row = ?", [(r,) for r in rows])
+        self._maps = None
+
+    def _maybe_compact(self):
+        total = self._rows_on_disk()
+        (live,) = self._conn.execute("SELECT COUNT(*) FROM chunk").fetchone()
+        if total and (total - live) / total > self.compact_ratio:
+            self.compact()
+
+    def compact(self):
+        """Rewrite the arrays without tombstoned rows and renumber the rest."""
+        with self._lock:
+            arrays = self._arrays()
+            if arrays is None:
+                return
+            keep = np.flatnonzero(np.asarray(arrays[2]) != TOMBSTONE)
+            for (name, _), array in zip(self._layout(), arrays):
+                tmp = self._file(name + ".tmp")
+                with open(tmp, "wb") as f:
+                    for start in range(0, len(keep), BLOCK_ROWS):
+                        f.write(array[keep[start : start + BLOCK_ROWS]].tobytes())
+                os.replace(tmp, self._file(name))
+            self._maps = None
+
+            # Every kept row moves down to its position in `keep`. Shift them
+            # out of the way first so the new numbers never collide.
+            offset = int(keep[-1]) + 1 if len(keep) else 0
+            self._conn.execute("UPDATE chunk SET row = row + ?", (offset,))
+            self._conn.executemany(
+                "UPDATE chunk SET row = ? WHERE row = ?",
+                [(new, int(old) + offset) for new, old in enumerate(keep)],
+            )
+            self._conn.commit()
+
+    def search(
+        self,
+        query_vector: list[float],
+        k: int,
+        src_ids: Sequence[int] | None,
+        include_vectors: bool = False,
+    ) -> list[tuple]:
+        query = _unit(np.asarray(query_vector, dtype=np.float32))
+        with self._lock:
+            arrays = self._arrays()
+            if arrays is None or arrays[0].shape[1] != query.shape[0]:
+                return []
+            codes, scales, sources, full = arrays
+            fetch = k * self.rescore_factor if full is not None else k
+            wanted = None if src_ids is None else np.asarray(src_ids, dtype=np.int32)
+
+            rows, scores = [], []
+            for start in range(0, len(sources), BLOCK_ROWS):
+                block = sources[start : start + BLOCK_ROWS]
+                if wanted is None:
+                    live = np.flatnonzero(block != TOMBSTONE)
+                else:
+                    live = np.flatnonzero(np.isin(block, wanted))
+                if not live.size:
+                    continue
+                live += start
+                block_scores = (codes[live].astype(np.float32) @ query) * scales[live]
+                if live.size > fetch:
+                    top = np.argpartition(block_scores, -fetch)[-fetch:]
+                    live, block_scores = live[top], block_scores[top]
+                rows.append(live)
+                scores.append(block_scores)
+            if not rows:
+                return []
+
+            rows = np.concatenate(rows)
+            scores = np.concatenate(scores)
+            if len(rows) > fetch:
+                top = np.argpartition(scores, -fetch)[-fetch:]
+                rows, scores = rows[top], scores[top]
+            if full is not None:
+                # Exact scores for the shortlist; sorted rows read the file in order
+                order = np.argsort(rows)
+                rows = rows[order]
+                scores = full[rows] @ query
+            best = np.argsort(scores)[::-1][:k]
+            hits = {int(rows[i]): float(scores[i]) for i in best}
+            vectors = {}
+            if include_vectors:
+                for i in best:
+                    row = rows[i]
+                    vectors[int(row)] = (
+                        np.array(full[row])
+                        if full is not None
+                        else codes[row].astype(np.float32) * scales[row]
+                    )
+
+            found = self._conn.execute(
+                "SELECT row, chunk_id, text, metadata FROM chunk"
+                f" WHERE row IN ({','.join('?' * len(hits))})",
+                list(hits),
+            ).fetchall()
+
+        results = [
+            (
+                Document(page_content=text, metadata=json.loads(metadata), id=chunk_id),
+                _relevance(hits[row]),
+            )
+            + ((vectors[row],) if include_vectors else ())
+            for row, chunk_id, text, metadata in found
+        ]
+        results.sort(key=lambda hit: hit[1], reverse=True)
+        return results
+
+    def pages(self, page_size: int) -> Iterator[dict[str, list]]:
+        last = -1
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT chunk_id, text, metadata, row FROM chunk"
+                    " WHERE row > ? ORDER BY row LIMIT ?",
+                    (last, page_size),
+                ).fetchall()
+            if not rows:
+                break
+            last = rows[-1][3]
+            yield self._page(rows, ["documents", "metadatas"])
+
+
+class ShardedQuantized(ShardedVectorStore):
+    """One QuantizedPartition directory per tenant under `root`."""
+
+    name = "vector_index"
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        root: str = "./vector_index",
+        rescore: bool = True,
+        **kwargs,
+    ):
+        super().__init__(embeddings, **kwargs)
+        self.root = root
+        self.rescore = rescore
+        os.makedirs(root, exist_ok=True)
+
+    def directory(self, tenant: str) -> str:
+        safe = "".join(c if c.isalnum() or c in "_-" else "_" for c in tenant)
+        return os.path.join(self.root, safe)
+
+    def _open_partition(self, tenant: str) -> QuantizedPartition:
+        return QuantizedPartition(
+            self.directory(tenant), self.embeddings, rescore=self.rescore
+        )
+
+    def _stored_tenants(self) -> set[str]:
+        return {t for t in database.get_tenants() if os.path.isdir(self.directory(t))}
@@ -0,0 +1,57 @@
+"""Process-wide resources shared by every Streamlit session.
+
+Streamlit re-runs the page script on every interaction. Anything expensive to
+build (API clients, the Chroma client, the database engine) is created here
+once per process and handed back to every rerun and every session.
+"""
+
+import time
+
+import streamlit as st
+from sqlalchemy import text
+from sqlalchemy.orm import scoped_session
+
+import database
+import metrics
+from agent import Agent
+from jobs import JobQueue
+
+
+@st.cache_resource(show_spinner="Starting up...")
+def get_agent(gemini_api_key: str, llamaidx_api_key: str) -> Agent:
+    """Build the Agent (LLM, embeddings, LlamaParse and Chroma clients) once."""
+    with metrics.span("startup.agent"):
+        return Agent(gemini_api_key, llamaidx_api_key)
+
+
+@st.cache_resource
+def get_job_queue(gemini_api_key: str, llamaidx_api_key: str) -> JobQueue:
+    """Start the background ingestion workers once per process."""
+    queue = JobQueue(get_agent(gemini_api_key, llamaidx_api_key).vector_store)
+    queue.start()
+    return queue
+
+
+@st.cache_resource
+def get_db_session() -> scoped_session:
+    """The shared session registry. Sessions themselves are per thread."""
+    # Open the first pooled connection now rather than on the first query
+    with metrics.span("startup.db_connect"), database.engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+    return database.db_session
+
+
+@st.cache_resource
+def start_metrics_exporter(path: str = "metrics.prom"):
+    """Write Prometheus histograms of every span to `path` in the background."""
+    return metrics.start_exporter(path)
+
+
+class RerunTimer:
+    """Measure how long a single script run takes."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+
+    def report(self, label: str = "rerun"):
+        metrics.observe(f"streamlit.{label}", time.perf_counter() - self.start)
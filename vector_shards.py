@@ -0,0 +1,361 @@
+"""Vector stores partitioned by tenant.
+
+Each tenant's chunks live in their own partition, so an index only grows
+with its tenant's corpus and a query only pays for the partitions it searches.
+Partitions are opened on first use and dropped once idle.
+
+Chunks are routed by the `src_id` in their metadata, through the tenant of
+that source in the database. ShardedVectorStore does the routing; backends
+subclass it to say how a partition is opened. A partition provides
+`add_documents`, `update_metadata`, `get`, `delete`, `search` and `pages`,
+as ChromaPartition does.
+"""
+
+import contextvars
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, Sequence
+
+import chromadb
+from chromadb.config import Settings
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+import database
+import metrics
+from database import DEFAULT_TENANT
+
+
+def _src_filter(src_ids: Sequence[int]) -> dict:
+    """Chroma `where` filter matching chunks from any of `src_ids`."""
+    if len(src_ids) == 1:
+        return {"src_id": src_ids[0]}
+    return {"src_id": {"$in": list(src_ids)}}
+
+
+class ShardedVectorStore(ABC):
+    # Prefix of the spans recorded for each partition operation
+    name = "vectors"
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        idle_seconds: float = 600,
+        max_open: int = 32,
+        max_concurrency: int = 4,
+    ):
+        self.embeddings = embeddings
+        self.idle_seconds = idle_seconds
+        self.max_open = max_open
+
+        self._lock = threading.Lock()
+        # tenant -> (partition, last used)
+        self._open: dict[str, tuple[object, float]] = {}
+        self._tenant_of: dict[int, str] = {}
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="shard-query"
+        )
+
+    @abstractmethod
+    def _open_partition(self, tenant: str): ...
+
+    @abstractmethod
+    def _stored_tenants(self) -> set[str]:
+        """Tenants whose partition exists on disk, if they can be listed."""
+
+    def partition(self, tenant: str):
+        """The partition for `tenant`, opening it if needed."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._open.get(tenant)
+            if entry is None:
+                with metrics.span(f"{self.name}.open", tenant=tenant):
+                    partition = self._open_partition(tenant)
+            else:
+                partition = entry[0]
+            self._open[tenant] = (partition, now)
+            self._evict(now)
+        return partition
+
+    def _evict(self, now: float):
+        """Drop partitions idle for too long, then the least recently used.
+
+        Searches already holding a dropped partition finish with it; it is
+        freed once the last of them lets go.
+        """
+        by_age = sorted(self._open.items(), key=lambda item: item[1][1])
+        for n, (tenant, (_, last_used)) in enumerate(by_age):
+            if now - last_used < self.idle_seconds and len(by_age) - n <= self.max_open:
+                break
+            del self._open[tenant]
+
+    def open_tenants(self) -> list[str]:
+        with self._lock:
+            return list(self._open)
+
+    def all_tenants(self) -> list[str]:
+        """Tenants with a partition on disk, plus any already open."""
+        stored = self._stored_tenants()
+        tenants = set(self.open_tenants())
+        tenants.update(t for t in database.get_tenants() if t in stored)
+        return sorted(tenants)
+
+    def partitions(self, src_ids: Iterable[int]) -> dict[str, list[int]]:
+        """Group source ids by the tenant whose partition holds their chunks."""
+        src_ids = list(src_ids)
+        missing = [i for i in src_ids if i not in self._tenant_of]
+        if missing:
+            self._tenant_of.update(database.get_source_tenants(missing))
+
+        grouped: dict[str, list[int]] = defaultdict(list)
+        for src_id in src_ids:
+            grouped[self._tenant_of.get(src_id, DEFAULT_TENANT)].append(src_id)
+        return dict(grouped)
+
+    def forget(self, src_ids: Iterable[int]):
+        """Drop cached tenants of deleted sources, whose ids may be reused."""
+        for src_id in src_ids:
+            self._tenant_of.pop(src_id, None)
+
+    def _by_tenant(self, items: Iterable, src_id_of) -> dict[str, list]:
+        items = list(items)
+        tenants = self.partitions({src_id_of(i) for i in items})
+        tenant_of = {
+            src_id: tenant for tenant, ids in tenants.items() for src_id in ids
+        }
+        grouped = defaultdict(list)
+        for item in items:
+            grouped[tenant_of[src_id_of(item)]].append(item)
+        return grouped
+
+    def add_documents(self, documents: Sequence[Document], ids: Sequence[str]):
+        """Embed and add documents to their tenants' partitions."""
+        pairs = zip(documents, ids)
+        grouped = self._by_tenant(pairs, lambda p: p[0].metadata.get("src_id", -1))
+        for tenant, batch in grouped.items():
+            self.partition(tenant).add_documents(
+                [d for d, _ in batch], [i for _, i in batch]
+            )
+
+    def update_metadata(self, ids: Sequence[str], metadatas: Sequence[dict]):
+        pairs = zip(ids, metadatas)
+        grouped = self._by_tenant(pairs, lambda p: p[1].get("src_id", -1))
+        for tenant, batch in grouped.items():
+            self.partition(tenant).update_metadata(
+                [i for i, _ in batch], [m for _, m in batch]
+            )
+
+    def get(self, src_ids: Sequence[int], include: list[str]) -> dict[str, list]:
+        """Every chunk stored for `src_ids`, merged across tenants."""
+        merged: dict[str, list] = {"ids": [], **{key: [] for key in include}}
+        for tenant, ids in self.partitions(src_ids).items():
+            page = self.partition(tenant).get(ids, include)
+            for key in merged:
+                merged[key].extend(page[key])
+        return merged
+
+    def delete(self, ids: Sequence[str], src_ids: Sequence[int]):
+        """Delete chunks by id from the partitions of `src_ids`."""
+        for tenant in self.partitions(src_ids):
+            self.partition(tenant).delete(list(ids))
+
+    def similarity_search(
+        self,
+        query_vector: list[float],
+        k: int,
+        src_ids: Sequence[int] | None = None,
+        score_threshold: float | None = None,
+        include_vectors: bool = False,
+    ) -> list[tuple]:
+        """Search the partitions holding `src_ids` and merge the best `k`.
+
+        None searches every tenant. Each partition is queried in parallel
+        with the same query vector, so the query is only embedded once.
+        Returns (Document, relevance) pairs, or (Document, relevance, stored
+        vector) triples with `include_vectors`.
+        """
+        if src_ids is None:
+            targets = {tenant: None for tenant in self.all_tenants()}
+        else:
+            targets = self.partitions(src_ids)
+
+        def search(tenant: str, ids: list[int] | None):
+            partition = self.partition(tenant)
+            with metrics.span(f"{self.name}.query", tenant=tenant, k=k):
+                return partition.search(query_vector, k, ids, include_vectors)
+
+        futures = [
+            self._pool.submit(contextvars.copy_context().run, search, tenant, ids)
+            for tenant, ids in targets.items()
+        ]
+        results = [hit for future in futures for hit in future.result()]
+        if score_threshold is not None:
+            results = [hit for hit in results if hit[1] >= score_threshold]
+        results.sort(key=lambda hit: hit[1], reverse=True)
+        return results[:k]
+
+    def pages(self, page_size: int = 1000) -> Iterator[dict[str, list]]:
+        """Every stored chunk with its text and metadata, a page at a time."""
+        for tenant in self.all_tenants():
+            yield from self.partition(tenant).pages(page_size)
+
+    def is_empty(self) -> bool:
+        return next(self.pages(1), None) is None
+
+
+class ChromaPartition:
+    """One tenant's Chroma collection."""
+
+    def __init__(self, store: Chroma):
+        self.store = store
+
+    def add_documents(self, documents: Sequence[Document], ids: Sequence[str]):
+        self.store.add_documents(list(documents), ids=list(ids))
+
+    def update_metadata(self, ids: Sequence[str], metadatas: Sequence[dict]):
+        self.store._collection.update(ids=list(ids), metadatas=list(metadatas))
+
+    def get(self, src_ids: Sequence[int], include: list[str]) -> dict[str, list]:
+        return self.store.get(where=_src_filter(src_ids), include=include)
+
+    def delete(self, ids: Sequence[str]):
+        self.store.delete(ids=list(ids))
+
+    def search(
+        self,
+        query_vector: list[float],
+        k: int,
+        src_ids: Sequence[int] | None,
+        include_vectors: bool = False,
+    ) -> list[tuple]:
+        include = ["documents", "metadatas", "distances"]
+        if include_vectors:
+            include.append("embeddings")
+        results = self.store._collection.query(
+            query_embeddings=[query_vector],
+            n_results=k,
+            where=None if src_ids is None else _src_filter(src_ids),
+            include=include,
+        )
+        # Chroma returns distances; convert them the same way for every shard
+        relevance = self.store._select_relevance_score_fn()
+        hits = []
+        for n, chunk_id in enumerate(results["ids"][0]):
+            doc = Document(
+                page_content=results["documents"][0][n],
+                metadata=results["metadatas"][0][n] or {},
+                id=chunk_id,
+            )
+            hit = (doc, relevance(results["distances"][0][n]))
+            if include_vectors:
+                hit += (results["embeddings"][0][n],)
+            hits.append(hit)
+        return hits
+
+    def pages(self, page_size: int) -> Iterator[dict[str, list]]:
+        offset = 0
+        while True:
+            page = self.store.get(
+                include=["documents", "metadatas"], limit=page_size, offset=offset
+            )
+            if not page["ids"]:
+                break
+            yield page
+            offset += len(page["ids"])
+
+
+class ShardedChroma(ShardedVectorStore):
+    """One Chroma collection per tenant.
+
+    All collections share one Chroma client whose segment cache is
+    LRU-bounded, so the HNSW indexes of collections that are no longer used
+    are also released from memory.
+    """
+
+    name = "chroma"
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        persist_directory: str = "./chroma_langchain_db",
+        prefix: str = "sources",
+        memory_limit_bytes: int = 1 << 30,
+        **kwargs,
+    ):
+        super().__init__(embeddings, **kwargs)
+        self.prefix = prefix
+        self.client = chromadb.PersistentClient(
+            path=persist_directory,
+            settings=Settings(
+                anonymized_telemetry=False,
+                chroma_segment_cache_policy="LRU",
+                chroma_memory_limit_bytes=memory_limit_bytes,
+            ),
+        )
+
+    def collection_name(self, tenant: str) -> str:
+        # Chroma names allow 3-63 characters from [a-zA-Z0-9._-]
+        safe = "".join(c if c.isalnum() or c in "_-" else "_" for c in tenant)
+        return f"{self.prefix}-{safe}"[:63]
+
+    def _open_partition(self, tenant: str) -> ChromaPartition:
+        return ChromaPartition(
+            Chroma(
+                client=self.client,
+                collection_name=self.collection_name(tenant),
+                embedding_function=self.embeddings,
+            )
+        )
+
+    def _collection_names(self) -> set[str]:
+        return {getattr(c, "name", c) for c in self.client.list_collections()}
+
+    def _stored_tenants(self) -> set[str]:
+        names = self._collection_names()
+        return {t for t in database.get_tenants() if self.collection_name(t) in names}
+
+    def migrate_collection(self, name: str, page_size: int = 1000):
+        """Move the chunks of an unpartitioned collection into their tenants'.
+
+        Embeddings are copied as they are, so nothing is re-embedded. The old
+        collection is deleted once everything has been moved.
+        """
+        if name not in self._collection_names():
+            return
+        legacy = self.client.get_collection(name)
+        offset = 0
+        with metrics.span("chroma.migrate", collection=name) as attrs:
+            while True:
+                page = legacy.get(
+                    include=["embeddings", "documents", "metadatas"],
+                    limit=page_size,
+                    offset=offset,
+                )
+                if not len(page["ids"]):
+                    break
+                rows = list(
+                    zip(
+                        page["ids"],
+                        page["embeddings"],
+                        page["documents"],
+                        page["metadatas"],
+                    )
+                )
+                grouped = self._by_tenant(
+                    rows, lambda r: (r[3] or {}).get("src_id", -1)
+                )
+                for tenant, batch in grouped.items():
+                    ids, embeddings, documents, metadatas = map(list, zip(*batch))
+                    self.partition(tenant).store._collection.upsert(
+                        ids=ids,
+                        embeddings=embeddings,
+                        documents=documents,
+                        metadatas=metadatas,
+                    )
+                offset += len(rows)
+            attrs["chunks"] = offset
+        self.client.delete_collection(name)
@@ -1,174 +1,631 @@
+import hashlib
+import os
 from collections import defaultdict
-from typing import IO, Sequence
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from importlib.metadata import version
+from typing import IO, Iterable, Iterator, Sequence
 
+import numpy as np
 import requests
-from langchain_chroma import Chroma
-from langchain_community.document_loaders import WebBaseLoader
+from bs4 import BeautifulSoup
 from langchain_core.documents.base import Document
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from llama_index.core import SimpleDirectoryReader
 from llama_parse import LlamaParse
+from requests.adapters import HTTPAdapter
+from sqlalchemy import update
 from streamlit.elements.lib.mutable_status_container import StatusContainer
+from urllib3.util.retry import Retry
 
 import database
+import metrics
+from context_builder import estimate_tokens
 from database import FileItem, SourceType
+from dedup import Duplicate, NearDuplicateIndex
+from embedding_cache import CachedEmbeddings, EmbeddingCache
+from embedding_writer import EmbeddingWriter, batched
+from lexical_index import LexicalIndex
+from mmr import mmr_select
+from quantized_store import ShardedQuantized
+from vector_shards import ShardedChroma, ShardedVectorStore
+
+EMBEDDING_MODEL = "text-embedding-004"
+
+# Cache keys for parsed text. Bump these when parsing or cleanup changes so
+# stale entries are ignored, then drop them with invalidate_parsed_text.
+PARSER_VERSION = f"llama-parse/{version('llama-parse')}"
+WEBPAGE_CLEANUP_VERSION = "llm-cleanup/1"
+
+WEBPAGE_CLEANUP_PROMPT = """
+                You are a specialized webpage parser.  
+                You will receive raw webpage content that may include navigation menus,
+                ads, scripts, styling, buttons, or repeated elements.
+
+                Your job is to extract ONLY the meaningful human-written content of the page
+                and return it as clean, well-structured Markdown.
+
+                Instructions:
+                - Remove all navigation items, headers, footers, ads, cookie popups, and scripts.
+                - Remove duplicate sections or repeated boilerplate.
+                - Keep ONLY the main article/content/important text.
+                - Preserve headings, subheadings, lists, tables, and code blocks.
+                - Fix broken or split sentences when possible.
+                - Do not invent new content — only reorganize what exists.
+                - Use concise, clean Markdown.
+
+                Respond ONLY with the cleaned Markdown.\n\n
+                Here is the page content:\n
+                """
+
+
+def _http_session(pool_size: int) -> requests.Session:
+    """A keep-alive session whose connection pool fits `pool_size` workers."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(
+            total=2, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504]
+        ),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = (
+        "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko)"
+        " Chrome/120.0 Safari/537.36"
+    )
+    return session
+
+
+def _page_to_document(url: str, content: bytes) -> Document:
+    """Turn a downloaded page into a Document the way WebBaseLoader does."""
+    soup = BeautifulSoup(content, "html.parser")
+    metadata = {"source": url, "title": url}
+    if soup.title and soup.title.get_text().strip():
+        metadata["title"] = soup.title.get_text().strip()
+    if description := soup.find("meta", attrs={"name": "description"}):
+        metadata["description"] = description.get("content", "")
+    if html := soup.find("html"):
+        metadata["language"] = html.get("lang", "")
+    return Document(page_content=soup.get_text(), metadata=metadata)
+
+
+def _reciprocal_rank_fusion(
+    rankings: Sequence[Sequence[tuple[Document, float]]], k: int, rrf_k: int = 60
+) -> list[tuple[Document, float]]:
+    """Merge ranked result lists, scoring each chunk by sum(1 / (rrf_k + rank)).
+
+    Scores are scaled so a chunk ranked first in every list scores 1.0.
+    """
+    scores: dict[str, float] = defaultdict(float)
+    docs: dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, (doc, _) in enumerate(ranking, start=1):
+            key = doc.id or f"{doc.metadata.get('src_id')}:{doc.metadata.get('chunk')}"
+            scores[key] += 1 / (rrf_k + rank)
+            docs.setdefault(key, doc)
+
+    best_possible = len(rankings) / (rrf_k + 1)
+    fused = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+    return [(docs[key], score / best_possible) for key, score in fused]
 
 
 class VectorStoreHelper:
-    def __init__(self, gemini_api_key, llama_idx_key, model: BaseChatModel):
+    def __init__(
+        self,
+        gemini_api_key,
+        llama_idx_key,
+        model: BaseChatModel,
+        batch_size: int = 64,
+        max_in_flight: int = 4,
+        embedding_requests_per_minute: float = 600,
+        max_concurrency: int = 8,
+        http_timeout: tuple[float, float] = (5, 30),
+        retrieval_mode: str = "hybrid",
+        vector_timeout: float = 10.0,
+        collection_idle_seconds: float = 600,
+        max_open_collections: int = 32,
+        dedup_threshold: float | None = 0.9,
+        vector_backend: str | None = None,
+        mmr_fetch_k: int = 20,
+        mmr_lambda: float = 0.5,
+        max_chunks_per_source: int | None = 2,
+        tenant: str | None = None,
+    ):
         self.parser = LlamaParse(
             api_key=llama_idx_key,
         )
-        self.embeddings = GoogleGenerativeAIEmbeddings(
-            model="text-embedding-004",
-            google_api_key=gemini_api_key,
+        self.embedding_cache = EmbeddingCache(
+            database.data_path("embedding_cache.sqlite")
+        )
+        self.embeddings = CachedEmbeddings(
+            GoogleGenerativeAIEmbeddings(
+                model=EMBEDDING_MODEL,
+                google_api_key=gemini_api_key,
+            ),
+            model_name=EMBEDDING_MODEL,
+            cache=self.embedding_cache,
+        )
+        self.vector_backend = vector_backend or os.environ.get(
+            "VECTOR_BACKEND", "chroma"
+        )
+        self.collections = self._vector_backend(
+            self.vector_backend,
+            idle_seconds=collection_idle_seconds,
+            max_open=max_open_collections,
+        )
+        # Partition that new sources are stored in
+        self.tenant = tenant or os.environ.get("TENANT", database.DEFAULT_TENANT)
+        self.lexical_index = LexicalIndex(database.data_path("lexical_index.sqlite"))
+        # Chunks at least this Jaccard-similar to an indexed one aren't embedded
+        self.dedup = (
+            NearDuplicateIndex(
+                database.data_path("dedup_index.sqlite"), threshold=dedup_threshold
+            )
+            if dedup_threshold is not None
+            else None
         )
-        self.vector_store = Chroma(
-            collection_name="testing",
-            embedding_function=self.embeddings,
-            persist_directory="./chroma_langchain_db",
+        if self.lexical_index.is_empty():
+            self.rebuild_lexical_index()
+        self.retrieval_mode = retrieval_mode
+        self.vector_timeout = vector_timeout
+        # Knobs of the "mmr" retrieval mode
+        self.mmr_fetch_k = mmr_fetch_k
+        self.mmr_lambda = mmr_lambda
+        self.max_chunks_per_source = max_chunks_per_source
+        self._search_pool = ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="vector-search"
         )
         self.model = model
+        self.writer = EmbeddingWriter(
+            self.collections,
+            self.lexical_index,
+            batch_size=batch_size,
+            max_in_flight=max_in_flight,
+            requests_per_minute=embedding_requests_per_minute,
+        )
+        self.max_concurrency = max_concurrency
+        self.http_timeout = http_timeout
+        self.http = _http_session(max_concurrency)
 
         self.db_session = database.db_session
 
-    def add_files(self, files: Sequence[IO[bytes]], status: StatusContainer):
-        fnames = []
-        source_items = {}
+        # Parser output from older versions will never be hit again
+        database.invalidate_parsed_text(keep=[PARSER_VERSION, WEBPAGE_CLEANUP_VERSION])
 
-        status.update(label="Receiving File")
+    def _vector_backend(self, name: str, **kwargs) -> ShardedVectorStore:
+        """Open the vector store named `name`: "chroma" or "quantized"."""
+        if name == "chroma":
+            store = ShardedChroma(
+                self.embeddings, persist_directory="./chroma_langchain_db", **kwargs
+            )
+            # Everything used to share one collection
+            store.migrate_collection("testing")
+            return store
+        if name == "quantized":
+            return ShardedQuantized(
+                self.embeddings, root=database.data_path("vector_index"), **kwargs
+            )
+        raise ValueError(f"Unknown vector backend {name!r}")
 
+    def add_files(self, files: Sequence[IO[bytes]], status: StatusContainer):
+        status.update(label="Receiving File")
+        source_items = self.store_files(files)
+        self.index_files(source_items, status)
+        return source_items
+
+    def store_files(
+        self, files: Sequence[IO[bytes]], replaceable: Iterable[int] = ()
+    ) -> list[FileItem]:
+        """Save uploads to the blob store and commit a FileItem for each.
+
+        An upload with the same name as one of the `replaceable` sources, such
+        as those already enabled in the chat, replaces that source's contents,
+        so re-indexing it only embeds the chunks that changed. Any other
+        upload becomes a new source.
+        """
+        replaceable = list(replaceable)
+        source_items = []
         for i in files:
-            path = f"uploads/{i.name}"
-            with open(path, "wb") as file:
-                file.write(i.read())
-
-            fnames.append(path)
-
             i.seek(0)
-
-            source_item = FileItem(
+            source_item = database.upsert_source(
+                i,
+                mime_type=getattr(i, "type", None),
                 title=i.name,
-                path=path,
+                path=i.name,
                 type=SourceType.FILE,
-                raw_bytes=i.read(),
+                tenant=self.tenant,
+                replaceable=replaceable,
             )
-            self.db_session.add(source_item)
-            source_items[i.name] = source_item
-
-        status.update(label="Retrieving text from file. This may take a moment")
-
-        # Just loading data with self.parser does not add any metadata :(
-        parsed_docs = SimpleDirectoryReader(
-            input_files=fnames, file_extractor={"*": self.parser}
-        ).load_data()
-
-        langchain_docs: list[Document] = [
-            Document(page_content=d.text, metadata=d.metadata) for d in parsed_docs
-        ]
-
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000, chunk_overlap=200, add_start_index=True
+            source_items.append(source_item)
+
+        database.commit()
+        return source_items
+
+    def index_files(self, source_items: Sequence[FileItem], status: StatusContainer):
+        """Parse stored FileItems and add their chunks to the vector store."""
+        by_name = {i.path: i for i in source_items}
+        self._ingest(
+            self._parse_files(by_name, status),
+            by_name,
+            source_key="file_name",
+            status=status,
         )
-        all_splits = text_splitter.split_documents(langchain_docs)
-
-        status.update(label="Adding file to vector store")
 
-        counters = defaultdict(int)
-        for d in all_splits:
-            for d in all_splits:
-                src = d.metadata.get("file_name") or "unknown"
-                page = d.metadata.get("page_label") or "unknown"
-                idx = counters[src]
-                counters[src] += 1
-
-                d.metadata["source"] = src
-                d.metadata["page"] = page
-                d.metadata["chunk"] = idx
-
-                d.metadata["src_id"] = source_items[src].id or -1
-
-                if "start_index" in d.metadata:
-                    start = d.metadata.get("start_index")
-                else:
-                    start = d.metadata.get("start")
+    def _parse_files(
+        self, source_items: dict[str, FileItem], status: StatusContainer
+    ) -> Iterator[Document]:
+        """Parse each file with LlamaParse, yielding its documents one file at a time."""
+        for n, (name, source_item) in enumerate(source_items.items(), start=1):
+            status.update(
+                label=f"Retrieving text from {name} ({n}/{len(source_items)}). "
+                "This may take a moment"
+            )
+            yield from self.parse_file(source_item)
+
+    def parse_file(self, source_item: FileItem) -> list[Document]:
+        """Parse a stored file, reusing cached text from an earlier parse."""
+        # Parse straight from the blob store instead of keeping a second copy
+        # of every upload on disk
+        return self._parse(source_item.blob_hash, source_item.path, source_item.open)
+
+    def parse_upload(self, file: IO[bytes]) -> list[Document]:
+        """Parse an uploaded file that isn't stored as a FileItem."""
+        file.seek(0)
+        blob_hash = hashlib.sha256(file.read()).hexdigest()
+
+        def reopen():
+            file.seek(0)
+            return nullcontext(file)
+
+        return self._parse(blob_hash, file.name, reopen)
+
+    def source_text(self, source_item: FileItem) -> list[Document]:
+        """Text of a stored source, from the cheapest place it is available.
+
+        Plain text is decoded directly, files go through the parse cache, and
+        web pages use their cleaned text or, failing that, their indexed chunks.
+        """
+        if source_item.type == SourceType.WEBPAGE:
+            cleaned = database.get_parsed_text(
+                source_item.blob_hash, WEBPAGE_CLEANUP_VERSION
+            )
+            if cleaned:
+                return [
+                    Document(
+                        page_content=d["text"], metadata={"source": source_item.path}
+                    )
+                    for d in cleaned
+                ]
+            indexed = self.collections.get(
+                [source_item.id], include=["documents", "metadatas"]
+            )
+            chunks = sorted(
+                zip(indexed["documents"], indexed["metadatas"]),
+                key=lambda c: c[1].get("chunk", 0),
+            )
+            return [Document(page_content=text, metadata=meta) for text, meta in chunks]
+
+        if (source_item.mime_type or "").startswith("text/plain"):
+            text = source_item.raw_bytes.decode(errors="replace")
+            return [
+                Document(page_content=text, metadata={"file_name": source_item.path})
+            ]
+
+        return self.parse_file(source_item)
+
+    def _parse(self, blob_hash: str, name: str, open_file) -> list[Document]:
+        cached = database.get_parsed_text(blob_hash, PARSER_VERSION)
+        if cached is None:
+            with open_file() as f:
+                with metrics.span("llamaparse.parse", file=name):
+                    parsed = self.parser.load_data(f, extra_info={"file_name": name})
+            cached = [{"text": d.text, "metadata": d.metadata} for d in parsed]
+            database.save_parsed_text(blob_hash, PARSER_VERSION, cached)
+
+        # The cache is shared by identical uploads, so take the name from the
+        # file being parsed rather than whichever upload was parsed first
+        return [
+            Document(
+                page_content=d["text"], metadata={**d["metadata"], "file_name": name}
+            )
+            for d in cached
+        ]
 
-                d.metadata["start"] = start
-                d.metadata["end"] = (
-                    start + len(d.page_content) if start is not None else None
+    def add_urls(
+        self,
+        urls: list[str],
+        status: StatusContainer,
+        created: list[int] | None = None,
+    ):
+        """Fetch, clean and index a batch of web pages.
+
+        Each page is downloaded once over a pooled keep-alive session, with at
+        most `max_concurrency` requests in flight. The same bytes are stored as
+        the FileItem and parsed into the Document. LLM cleanup of all pages is
+        then run concurrently. Pages that fail to download or clean are
+        skipped and reported on `status`.
+
+        Args:
+            created: If given, the ids of sources this call created are added
+                to it as soon as they are committed, so a caller can remove
+                them if indexing fails afterwards.
+        """
+        status.update(label=f"Retrieving {len(urls)} web page(s)")
+        pages: dict[str, bytes] = {}
+        failed: list[str] = []
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            futures = {pool.submit(self._fetch, url): url for url in urls}
+            for n, future in enumerate(as_completed(futures), start=1):
+                url = futures[future]
+                try:
+                    pages[url] = future.result()
+                except requests.RequestException:
+                    # Its web.fetch span has the error
+                    failed.append(url)
+                status.update(label=f"Retrieved {n}/{len(urls)} web pages")
+
+        docs = [_page_to_document(url, pages[url]) for url in urls if url in pages]
+
+        # Pages whose exact bytes were cleaned before reuse that result
+        hashes = {
+            url: hashlib.sha256(content).hexdigest() for url, content in pages.items()
+        }
+        cleaned: dict[str, str | Exception] = {}
+        to_clean = []
+        for doc in docs:
+            url = doc.metadata["source"]
+            hit = database.get_parsed_text(hashes[url], WEBPAGE_CLEANUP_VERSION)
+            if hit:
+                cleaned[url] = hit[0]["text"]
+            else:
+                to_clean.append(doc)
+
+        if to_clean:
+            status.update(label="Cleaning webpage content. This may take a while.")
+            with metrics.span("llm.webpage_cleanup", pages=len(to_clean)) as attrs:
+                results = self.model.batch(
+                    [WEBPAGE_CLEANUP_PROMPT + doc.page_content for doc in to_clean],
+                    config={"max_concurrency": self.max_concurrency},
+                    return_exceptions=True,
+                )
+                attrs["failed"] = {
+                    doc.metadata["source"]: repr(result)
+                    for doc, result in zip(to_clean, results)
+                    if isinstance(result, Exception)
+                }
+            for doc, result in zip(to_clean, results):
+                url = doc.metadata["source"]
+                if isinstance(result, Exception):
+                    cleaned[url] = result
+                    continue
+                cleaned[url] = str(result.content)
+                database.save_parsed_text(
+                    hashes[url],
+                    WEBPAGE_CLEANUP_VERSION,
+                    [{"text": cleaned[url], "metadata": {}}],
                 )
 
-        self.vector_store.add_documents(all_splits)
-
-        self.db_session.commit()
-        return list(source_items.values())
-
-    def add_urls(self, urls: list[str], status: StatusContainer):
-        status.update(label="Retrieving web page")
-        raw_pages = [requests.get(url).content for url in urls]
-        loader = WebBaseLoader(urls)
-
-        docs = loader.load()
         source_items = {}
-        status.update(label="Cleaning webpage content. This may take a while.")
-        with self.db_session() as session:
-            for raw_page, doc in zip(raw_pages, docs):
-                doc.page_content = str(
-                    self.model.invoke(
-                        """
-                You are a specialized webpage parser.  
-                You will receive raw webpage content that may include navigation menus,
-                ads, scripts, styling, buttons, or repeated elements.
+        new_items = []
+        kept_docs = []
+        for doc in docs:
+            url = doc.metadata["source"]
+            result = cleaned[url]
+            if isinstance(result, Exception):
+                # Reported in the llm.webpage_cleanup span
+                failed.append(url)
+                continue
+
+            doc.page_content = result
+            source_item = database.upsert_source(
+                pages.pop(url),
+                mime_type="text/html",
+                title=doc.metadata["title"],
+                path=url,
+                type=SourceType.WEBPAGE,
+                tenant=self.tenant,
+            )
+            if source_item.id is None:
+                new_items.append(source_item)
+            source_items[url] = source_item
+            kept_docs.append(doc)
 
-                Your job is to extract ONLY the meaningful human-written content of the page
-                and return it as clean, well-structured Markdown.
+        # Commit before indexing so no write lock is held while embedding
+        self.db_session.commit()
+        if created is not None:
+            created.extend(i.id for i in new_items)
+        self._ingest(kept_docs, source_items, source_key="source", status=status)
 
-                Instructions:
-                - Remove all navigation items, headers, footers, ads, cookie popups, and scripts.
-                - Remove duplicate sections or repeated boilerplate.
-                - Keep ONLY the main article/content/important text.
-                - Preserve headings, subheadings, lists, tables, and code blocks.
-                - Fix broken or split sentences when possible.
-                - Do not invent new content — only reorganize what exists.
-                - Use concise, clean Markdown.
+        if failed:
+            status.update(label=f"Could not add: {', '.join(failed)}")
+        return list(source_items.values())
 
-                Respond ONLY with the cleaned Markdown.\n\n
-                Here is the page content:\n
-                """
-                        + doc.page_content
-                    ).content
-                )
+    def _fetch(self, url: str) -> bytes:
+        with metrics.span("web.fetch", url=url) as attrs:
+            try:
+                response = self.http.get(url, timeout=self.http_timeout)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                attrs["error"] = repr(e)
+                raise
+            return response.content
+
+    def _ingest(
+        self,
+        docs: Iterable[Document],
+        source_items: dict[str, FileItem],
+        source_key: str,
+        status: StatusContainer,
+    ):
+        """Split, normalize, embed and store documents as a streaming pipeline.
+
+        Every stage is a generator, so at most `batch_size * max_in_flight`
+        chunks are held between splitting and the vector store no matter how
+        large the documents are.
+
+        Chunk ids are derived from each chunk's source and text, so indexing
+        is a diff against what the sources already have stored: only new
+        chunks are embedded, chunks that merely moved get their metadata
+        updated, and chunks that no longer exist are deleted once the new
+        ones are written. A failed ingestion therefore resumes where it
+        stopped, and re-indexing an edited source only pays for the edits.
+
+        New chunks that nearly duplicate one already indexed for the same
+        tenant are recorded against it in `self.dedup` instead of embedded.
+
+        Args:
+            docs: Parsed documents, possibly produced lazily.
+            source_items: FileItems keyed by the value of `source_key` in each
+                document's metadata.
+            source_key: Metadata field naming the document's source.
+            status: Status widget to report per-stage progress to.
+        """
+        splits = metrics.timed_iter("ingest.split", self._split(docs))
+        normalized = metrics.timed_iter(
+            "ingest.normalize",
+            self._normalize_metadata(splits, source_items, source_key),
+        )
 
-                source_item = FileItem(
-                    title=doc.metadata["title"],
-                    path=doc.metadata["source"],
-                    type=SourceType.WEBPAGE,
-                    raw_bytes=raw_page,
-                )
-                session.add(source_item)
-                session.commit()
-                source_items[doc.metadata["source"]] = source_item
+        src_ids = [i.id for i in source_items.values()]
+        tenants = {i.id: i.tenant for i in source_items.values()}
+        stored = self._stored_chunks(src_ids)
+        seen: set[str] = set()
+        counts: dict[int, int] = defaultdict(int)
+        moved: list[Document] = []
+
+        duplicates = self.dedup.duplicates(src_ids) if self.dedup else {}
+        signed = self.dedup.signed(stored) if self.dedup else set()
+        dedup = self.dedup.batch() if self.dedup else None
+
+        def new_chunks() -> Iterator[Document]:
+            for d in normalized:
+                seen.add(d.id)
+                src_id = d.metadata["src_id"]
+                counts[src_id] += 1
+                tenant = tenants.get(src_id, database.DEFAULT_TENANT)
+                if d.id in duplicates:
+                    # Refresh its text and metadata, they may have moved
+                    dedup.add_duplicate(d, tenant, *duplicates[d.id])
+                elif d.id not in stored:
+                    if dedup is None or not dedup.classify(d, tenant):
+                        yield d
+                else:
+                    if dedup is not None and d.id not in signed:
+                        dedup.add_original(d, tenant)
+                    if any(
+                        stored[d.id].get(key) != d.metadata.get(key)
+                        for key in ("chunk", "start", "end", "page", "title")
+                    ):
+                        moved.append(d)
+
+        with metrics.span("ingest.write", sources=len(src_ids)) as attrs:
+            written = self.writer.write(new_chunks(), status)
+            attrs["chunks"] = written
+            if dedup is not None:
+                self.dedup.save(dedup)
+                attrs["duplicates"] = dedup.collapsed
+                attrs["saved_chars"] = dedup.saved_chars
+
+        for batch in batched(moved, self.writer.batch_size):
+            ids = [d.id for d in batch]
+            self.collections.update_metadata(ids, [d.metadata for d in batch])
+            self.lexical_index.upsert(ids, batch)
+
+        stale = [i for i in stored if i not in seen]
+        if stale:
+            self.collections.delete(stale, src_ids)
+            self.lexical_index.delete(stale)
+        if self.dedup:
+            stale_duplicates = [i for i in duplicates if i not in seen]
+            self._promote(self.dedup.release(stale + stale_duplicates))
+
+        for src_id in src_ids:
+            self.db_session.execute(
+                update(FileItem)
+                .where(FileItem.id == src_id)
+                .values(indexed_chunks=counts[src_id])
+            )
+        self.db_session.commit()
 
+        label = (
+            f"Indexed {len(seen)} chunks: {written} embedded,"
+            f" {len(moved)} moved, {len(stale)} removed"
+        )
+        if dedup is not None and dedup.collapsed:
+            label += f", {dedup.collapsed} near-duplicates skipped"
+        status.update(label=label)
+
+    def _promote(self, orphans: Sequence[Duplicate]):
+        """Index duplicates whose original was deleted in its place.
+
+        Orphans that are near-duplicates of each other are collapsed again,
+        so only one of each group is embedded.
+        """
+        if not orphans:
+            return
+        dedup = self.dedup.batch()
+        promoted = [
+            o.document for o in orphans if not dedup.classify(o.document, o.tenant)
+        ]
+        with metrics.span("ingest.promote", chunks=len(promoted)):
+            self.writer.write(promoted)
+        self.dedup.save(dedup)
+
+    def _stored_chunks(self, src_ids: Sequence[int]) -> dict[str, dict]:
+        """Map the id of every chunk stored for `src_ids` to its metadata."""
+        if not src_ids:
+            return {}
+        with metrics.span("chroma.get", sources=len(src_ids)):
+            stored = self.collections.get(src_ids, include=["metadatas"])
+        return {
+            chunk_id: metadata or {}
+            for chunk_id, metadata in zip(stored["ids"], stored["metadatas"])
+        }
+
+    def delete_source(self, source_item: FileItem):
+        """Delete a source along with its chunks in both indexes."""
+        chunk_ids = list(self._stored_chunks([source_item.id]))
+        if chunk_ids:
+            self.collections.delete(chunk_ids, [source_item.id])
+        self.lexical_index.delete_sources([source_item.id])
+        if self.dedup:
+            duplicates = self.dedup.duplicates([source_item.id])
+            self._promote(self.dedup.release([*chunk_ids, *duplicates]))
+        database.delete_source(source_item)
+        self.collections.forget([source_item.id])
+
+    def _split(self, docs: Iterable[Document]) -> Iterator[Document]:
         text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=1000, chunk_overlap=200, add_start_index=True
         )
-        all_splits = text_splitter.split_documents(docs)
-
+        for doc in docs:
+            yield from text_splitter.split_documents([doc])
+
+    def _normalize_metadata(
+        self,
+        splits: Iterable[Document],
+        source_items: dict[str, FileItem],
+        source_key: str,
+    ) -> Iterator[Document]:
+        """Fill in the metadata fields retrieval relies on, one chunk at a time."""
         counters = defaultdict(int)
-        for d in all_splits:
-            src = d.metadata.get("source") or "unknown"
-            title = d.metadata.get("title") or src
+        repeats = defaultdict(int)
+        for d in splits:
+            src = d.metadata.get(source_key) or "unknown"
             idx = counters[src]
             counters[src] += 1
 
-            # normalize fields
             d.metadata["source"] = src
-            d.metadata["title"] = title
-            d.metadata["src_id"] = source_items[src].id or -1
+            d.metadata["title"] = d.metadata.get("title") or src
+            d.metadata["page"] = d.metadata.get("page_label") or "unknown"
             d.metadata["chunk"] = idx
 
+            source_item = source_items.get(src)
+            d.metadata["src_id"] = (source_item.id if source_item else None) or -1
+
             if "start_index" in d.metadata:
                 start = d.metadata.get("start_index")
             else:
@@ -179,10 +636,230 @@ class VectorStoreHelper:
                 start + len(d.page_content) if start is not None else None
             )
 
-        status.update(label="Adding webpage to vector store")
+            # The id depends only on the source and the text, so a chunk keeps
+            # it when edits elsewhere in the source shift its position.
+            # Identical chunks within a source are numbered to stay unique.
+            text_hash = hashlib.sha256(d.page_content.encode()).hexdigest()[:32]
+            key = (d.metadata["src_id"], text_hash)
+            d.id = f"{d.metadata['src_id']}-{text_hash}"
+            if repeats[key]:
+                d.id += f"-{repeats[key]}"
+            repeats[key] += 1
+            yield d
+
+    def similarity_search(
+        self,
+        query: str,
+        k=4,
+        src_ids: Iterable[int] | None = None,
+        score_threshold: float | None = None,
+        mode: str | None = None,
+        query_vector: list[float] | None = None,
+        token_budget: int | None = None,
+    ):
+        """Return up to `k` (Document, relevance score) pairs for `query`.
+
+        Args:
+            query: Text to search for.
+            k: Maximum number of chunks to return.
+            src_ids: Only search chunks from these FileItem ids. The filter is
+                applied inside each index, before ranking. None searches
+                everything. Chunks of these sources that were collapsed into
+                a near-duplicate elsewhere are found through it and returned
+                as themselves.
+            score_threshold: Drop vector results with a relevance score below
+                this.
+            mode: "vector", "lexical", "hybrid" or "mmr". Defaults to
+                `self.retrieval_mode`. Lexical search never calls the
+                embedding API. Hybrid fuses both rankings with reciprocal rank
+                fusion and falls back to lexical results if the vector search
+                fails or takes longer than `self.vector_timeout` seconds. MMR
+                over-fetches `self.mmr_fetch_k` vector hits and picks a diverse
+                subset of them, see `_mmr_search`.
+            query_vector: Embedding of `query`, if the caller already has
+                one. Otherwise it is embedded here.
+            token_budget: Estimated tokens the results may fill. Only MMR
+                selects within it; other modes leave budgeting to the caller.
+        """
+        mode = mode or self.retrieval_mode
+        if src_ids is not None:
+            src_ids = sorted(set(src_ids))
+            if not src_ids:
+                return []
+
+        aliases = self.dedup.aliases(src_ids) if self.dedup and src_ids else {}
+        if not aliases:
+            with metrics.span("retrieval", mode=mode, k=k):
+                return self._search(
+                    query, k, src_ids, score_threshold, mode, query_vector, token_budget
+                )
 
-        self.vector_store.add_documents(all_splits)
-        return list(source_items.values())
+        # Also search the sources holding the originals, with room for hits
+        # there that aren't stand-ins for one of ours
+        search_ids = sorted({*src_ids, *(src for src, _ in aliases.values())})
+        with metrics.span("retrieval", mode=mode, k=k, aliases=len(aliases)):
+            results = self._search(
+                query,
+                k * 2,
+                search_ids,
+                score_threshold,
+                mode,
+                query_vector,
+                token_budget,
+            )
+
+        wanted = set(src_ids)
+        resolved = []
+        for doc, score in results:
+            if doc.metadata.get("src_id") in wanted:
+                resolved.append((doc, score))
+            elif doc.id in aliases:
+                resolved.append((aliases[doc.id][1], score))
+        return resolved[:k]
+
+    def _search(
+        self,
+        query: str,
+        k: int,
+        src_ids: list[int] | None,
+        score_threshold: float | None,
+        mode: str,
+        query_vector: list[float] | None = None,
+        token_budget: int | None = None,
+    ):
+        if mode == "vector":
+            return self._vector_search(query, k, src_ids, score_threshold, query_vector)
+        if mode == "lexical":
+            return self._lexical_search(query, k, src_ids)
+        if mode == "mmr":
+            return self._mmr_search(
+                query, k, src_ids, score_threshold, query_vector, token_budget
+            )
+        if mode != "hybrid":
+            raise ValueError(f"Unknown retrieval mode {mode!r}")
 
-    def similarity_search(self, query: str, k=4):
-        return self.vector_store.similarity_search_with_relevance_scores(query, k=k)
+        fetch_k = max(k * 4, 20)
+        vector_future = self._search_pool.submit(
+            self._vector_search, query, fetch_k, src_ids, score_threshold, query_vector
+        )
+        lexical = self._lexical_search(query, fetch_k, src_ids)
+        with metrics.span(
+            "retrieval.vector_wait", timeout=self.vector_timeout
+        ) as attrs:
+            try:
+                vector = vector_future.result(timeout=self.vector_timeout)
+            except Exception as e:
+                # Answer from the keyword results alone, and say so in the span
+                attrs["fallback"] = repr(e)
+                return lexical[:k]
+
+        return _reciprocal_rank_fusion([vector, lexical], k)
+
+    def _vector_search(
+        self,
+        query: str,
+        k: int,
+        src_ids: list[int] | None,
+        score_threshold: float | None,
+        query_vector: list[float] | None = None,
+    ):
+        if query_vector is None:
+            query_vector = self.embeddings.embed_query(query)
+        return self.collections.similarity_search(
+            query_vector, k, src_ids, score_threshold
+        )
+
+    def _mmr_search(
+        self,
+        query: str,
+        k: int,
+        src_ids: list[int] | None,
+        score_threshold: float | None,
+        query_vector: list[float] | None = None,
+        token_budget: int | None = None,
+    ):
+        """Up to `k` relevant but mutually dissimilar chunks.
+
+        Candidates come back from the vector store with their stored vectors,
+        so re-ranking needs no embedding calls beyond the query's. At most
+        `self.max_chunks_per_source` chunks are taken from one source, and
+        picks stop once `token_budget` would be exceeded.
+        """
+        if query_vector is None:
+            query_vector = self.embeddings.embed_query(query)
+        candidates = self.collections.similarity_search(
+            query_vector,
+            max(self.mmr_fetch_k, k),
+            src_ids,
+            score_threshold,
+            include_vectors=True,
+        )
+        if not candidates:
+            return []
+
+        with metrics.span("retrieval.mmr", candidates=len(candidates)) as attrs:
+            picks = mmr_select(
+                query_vector,
+                np.array([vector for _, _, vector in candidates], dtype=np.float32),
+                sources=[doc.metadata.get("src_id") for doc, _, _ in candidates],
+                tokens=[estimate_tokens(doc.page_content) for doc, _, _ in candidates],
+                k=k,
+                lambda_mult=self.mmr_lambda,
+                per_source_cap=self.max_chunks_per_source,
+                token_budget=token_budget,
+            )
+            attrs["picked"] = len(picks)
+        return [candidates[i][:2] for i in picks]
+
+    def _lexical_search(self, query: str, k: int, src_ids: list[int] | None):
+        with metrics.span("lexical.query", k=k):
+            results = self.lexical_index.search(query, k=k, src_ids=src_ids)
+        if not results:
+            return []
+        # BM25 scores are unbounded, so scale them against the best hit
+        best = max(score for _, _, score in results) or 1.0
+        docs = []
+        for chunk_id, doc, score in results:
+            doc.id = chunk_id
+            docs.append((doc, max(score, 0.0) / best))
+        return docs
+
+    def backfill_vectors(self, status: StatusContainer | None = None) -> int:
+        """Embed the chunks of the lexical index missing from the vector store.
+
+        Fills a newly selected vector backend, with embeddings from the
+        embedding cache wherever the chunk was embedded before. Sources are
+        compared one at a time and only missing chunks are written, so an
+        interrupted backfill carries on where it stopped. Returns how many
+        chunks were written.
+        """
+        src_ids = self.lexical_index.source_ids()
+        written = 0
+        with metrics.span("ingest.backfill", sources=len(src_ids)) as attrs:
+            for n, src_id in enumerate(src_ids, start=1):
+                stored = set(self.collections.get([src_id], include=[])["ids"])
+                missing = [
+                    d
+                    for d in self.lexical_index.documents(src_id)
+                    if d.id not in stored
+                ]
+                if missing:
+                    written += self.writer.write(missing)
+                if status is not None:
+                    status.update(
+                        label=f"Backfilled {n}/{len(src_ids)} sources "
+                        f"({written} chunks embedded)"
+                    )
+            attrs["chunks"] = written
+        return written
+
+    def rebuild_lexical_index(self, page_size: int = 1000):
+        """Index every chunk already in Chroma, e.g. after upgrading."""
+        for page in self.collections.pages(page_size):
+            self.lexical_index.add(
+                page["ids"],
+                [
+                    Document(page_content=text, metadata=meta or {})
+                    for text, meta in zip(page["documents"], page["metadatas"])
+                ],
+            )